@@ -1,4 +1,4 @@
-from flask import Flask, render_template, redirect, url_for, request, send_file, flash, session, jsonify
+from flask import Flask, render_template, redirect, url_for, request, send_file, flash, session, jsonify, Response, stream_with_context, g
 import os
 import json
 import csv
@@ -6,14 +6,65 @@ import math
 from io import StringIO, BytesIO
 import sqlite3
 import random
-from datetime import datetime, timedelta
+import heapq
+from datetime import datetime, date as date_cls, timedelta
 from calendar import monthrange
 from werkzeug.security import generate_password_hash, check_password_hash
-from functools import wraps
+from functools import wraps, lru_cache
+from collections import defaultdict
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
 app.secret_key = 'nurse-secret-key'  # session 用
 
+# 日期範圍內的 On Call 人員（可再附加 AND 條件）
+ONCALL_RANGE_SQL = '''
+    SELECT ocs.*, s.name as staff_name
+    FROM oncall_schedule ocs
+    JOIN staff s ON ocs.staff_id = s.staff_id
+    WHERE ocs.date BETWEEN ? AND ?
+'''
+
+# 與查詢範圍重疊的已核准請假
+APPROVED_LEAVE_OVERLAP_SQL = '''
+    SELECT staff_id, start_date, end_date, leave_type
+    FROM leave_schedule
+    WHERE approved = 1 AND start_date <= ? AND end_date >= ?
+'''
+
+# 請假假別（依畫面顯示順序）；上傳驗證用 frozenset
+LEAVE_TYPES = ('事假', '病假', '特休', '婚假', '喪假', '產假', '陪產假', '其他')
+VALID_LEAVE_TYPES = frozenset(LEAVE_TYPES)
+
+# 星期中文名稱，依 date.weekday() 索引（0=週一 ... 6=週日）
+WEEKDAY_CN = ('一', '二', '三', '四', '五', '六', '日')
+
+# CSV 匯出每批寫出的資料列數
+EXPORT_CHUNK_SIZE = 1000
+
+# 密碼雜湊參數（scrypt，單次驗證約數十毫秒）；舊參數的雜湊於登入成功時重新產生
+PASSWORD_HASH_METHOD = 'scrypt:32768:8:1'
+# 批次匯入使用者時的雜湊執行緒上限（每個 scrypt 雜湊約佔 32MiB 記憶體，避免小型主機記憶體不足）
+PASSWORD_HASH_WORKERS = min(4, os.cpu_count() or 1)
+
+# 常用查詢索引（啟動時建立）
+INDEX_DDL = [
+    # 排班：依日期範圍刪除/查詢、依員工查詢
+    'CREATE INDEX IF NOT EXISTS idx_schedule_date_staff ON schedule (date, staff_id)',
+    'CREATE INDEX IF NOT EXISTS idx_schedule_staff_date ON schedule (staff_id, date)',
+    # 請假：自動排班讀取日期範圍內已核准請假（覆蓋索引）
+    'CREATE INDEX IF NOT EXISTS idx_leave_approved_dates ON leave_schedule (approved, start_date, end_date, staff_id)',
+    # 請假管理依員工篩選
+    'CREATE INDEX IF NOT EXISTS idx_leave_staff_dates ON leave_schedule (staff_id, start_date, end_date)',
+    # On Call：依員工查詢（依日期查詢已有 UNIQUE(date, staff_id) 索引）
+    'CREATE INDEX IF NOT EXISTS idx_oncall_staff_date ON oncall_schedule (staff_id, date)',
+]
+
+def hash_password(password):
+    """以統一參數產生密碼雜湊"""
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
 def validate_schedule_requirements(dates, staff_list, shifts, night_shift_allocations, total_weeks):
     """
     驗證排班結果是否符合需求
@@ -27,6 +78,8 @@ def validate_schedule_requirements(dates, staff_list, shifts, night_shift_alloca
         'overall_passed': True
     }
     
+    weekdays = consecutive_weekdays(dates)
+    
     try:
         # 1. 檢查大夜班預先分配是否優先安排
         for date in dates:
@@ -62,9 +115,9 @@ def validate_schedule_requirements(dates, staff_list, shifts, night_shift_alloca
                 rest_day_count = 0
                 work_days = []
                 
-                for date in week_dates:
-                    date_obj = datetime.strptime(date, '%Y-%m-%d')
-                    is_sunday = date_obj.weekday() == 6
+                for i in range(start_idx, end_idx):
+                    date = dates[i]
+                    is_sunday = weekdays[i] == 6
                     
                     # 檢查該員工在該日期是否有排班
                     work_assignment = conn.execute('''
@@ -90,7 +143,7 @@ def validate_schedule_requirements(dates, staff_list, shifts, night_shift_alloca
                             rest_day_count += 1
                 
                 # 檢查是否至少有一天休息日（週一到週六）
-                if rest_day_count == 0 and len([d for d in week_dates if datetime.strptime(d, '%Y-%m-%d').weekday() < 6]) > 0:
+                if rest_day_count == 0 and any(weekdays[i] < 6 for i in range(start_idx, end_idx)):
                     validation_results['rest_days_arrangement']['passed'] = False
                     validation_results['rest_days_arrangement']['details'].append(
                         f"休息日不足：第{week_num}週 員工 {staff_id} 沒有平日休息日"
@@ -144,13 +197,11 @@ def validate_schedule_requirements(dates, staff_list, shifts, night_shift_alloca
         validation_results['overall_passed'] = False
         validation_results['error'] = str(e)
     
-    finally:
-        conn.close()
-    
     return validation_results['overall_passed'], validation_results
 
 def init_db():
     conn = sqlite3.connect(os.path.join('data', 'staff.db'))
+    conn.execute('PRAGMA journal_mode = WAL')  # 寫入時不阻擋讀取，設定會保存在資料庫檔
     c = conn.cursor()
     c.execute('CREATE TABLE IF NOT EXISTS staff (staff_id TEXT PRIMARY KEY, name TEXT, title TEXT, ward TEXT)')
     c.execute('CREATE TABLE IF NOT EXISTS shift (shift_id TEXT PRIMARY KEY, name TEXT, time TEXT, required_count INTEGER, ward TEXT)')
@@ -256,24 +307,91 @@ def init_db():
         FOREIGN KEY (staff_id) REFERENCES staff (staff_id)
     )''')
     
+    # 常用查詢索引
+    for stmt in INDEX_DDL:
+        c.execute(stmt)
+    
     # 檢查是否已有 admin 帳號，若無則建立預設管理員
     admin = c.execute('SELECT * FROM user WHERE username = ?', ('admin',)).fetchone()
     if not admin:
-        pw_hash = generate_password_hash('admin123')
+        pw_hash = hash_password('admin123')
         c.execute('INSERT INTO user (username, password_hash, role) VALUES (?, ?, ?)', ('admin', pw_hash, 'admin'))
     conn.commit()
     conn.close()
 
 init_db()
 
-def get_db_connection():
+def open_db_connection():
     conn = sqlite3.connect(os.path.join('data', 'staff.db'))
     conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA synchronous = NORMAL')  # WAL 模式下安全且減少 fsync
+    conn.execute('PRAGMA temp_store = MEMORY')   # 排序/暫存表放記憶體
+    conn.execute('PRAGMA cache_size = -65536')   # 頁面快取 64MB（負值單位為 KiB）
     return conn
 
+def get_db_connection():
+    """取得資料庫連線：同一請求共用 flask.g 上的連線，請求結束時由 close_db_connection 關閉"""
+    if 'db' not in g:
+        g.db = open_db_connection()
+    return g.db
+
+@app.teardown_appcontext
+def close_db_connection(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        conn.close()
+
+def month_date_range(month_str):
+    """回傳月份 (yyyy-mm) 的 [當月第一天, 次月第一天) 日期字串，供範圍查詢使用"""
+    year, mon = map(int, month_str.split('-'))
+    return f"{year:04d}-{mon:02d}-01", f"{year + mon // 12:04d}-{mon % 12 + 1:02d}-01"
+
+def parse_date(date_str):
+    """解析 YYYY-MM-DD 日期字串（fromisoformat 比 strptime 快）"""
+    # fromisoformat 也接受 20250714、2025-W27-6 等格式，只在標準格式時走快速路徑
+    if len(date_str) == 10 and date_str[4] == date_str[7] == '-':
+        return date_cls.fromisoformat(date_str)
+    # 舊資料可能有未補零的日期（如 2025-8-5），沿用 strptime 的寬鬆解析
+    return datetime.strptime(date_str, '%Y-%m-%d').date()
+
+def consecutive_weekdays(dates):
+    """連續日期清單對應的星期（0=週一 ... 6=週日），只需解析第一天"""
+    if not dates:
+        return []
+    first_weekday = parse_date(dates[0]).weekday()
+    return [(first_weekday + i) % 7 for i in range(len(dates))]
+
+def sundays_between(start, end):
+    """計算 start～end（含）之間的星期天數量"""
+    first_sunday = start + timedelta(days=(6 - start.weekday()) % 7)
+    if first_sunday > end:
+        return 0
+    return (end - first_sunday).days // 7 + 1
+
+def clear_months_schedule(conn, months):
+    """刪除指定月份的排班與週工時統計"""
+    conn.executemany('DELETE FROM schedule WHERE date >= ? AND date < ?',
+                     [month_date_range(m) for m in months])
+    placeholder = ','.join('?' for _ in months)
+    conn.execute(f'DELETE FROM weekly_work_stats WHERE month IN ({placeholder})', list(months))
+
+def load_leave_dates(conn, dates):
+    """讀取排班日期範圍內已核准的請假，回傳 {staff_id: set(請假日期)}"""
+    leave_dates = defaultdict(set)
+    if not dates:
+        return leave_dates
+    rows = conn.execute(APPROVED_LEAVE_OVERLAP_SQL, (dates[-1], dates[0])).fetchall()
+    for row in rows:
+        # 只展開與排班範圍重疊的日期
+        start_obj = parse_date(max(row['start_date'], dates[0]))
+        end_obj = parse_date(min(row['end_date'], dates[-1]))
+        for offset in range((end_obj - start_obj).days + 1):
+            leave_dates[row['staff_id']].add((start_obj + timedelta(days=offset)).strftime('%Y-%m-%d'))
+    return leave_dates
+
 def migrate_existing_data():
     """將現有資料遷移到新結構"""
-    conn = get_db_connection()
+    conn = open_db_connection()  # 啟動時執行，不在請求中
     
     try:
         # 1. 將現有班別的 required_count 複製到每日需求表
@@ -341,6 +459,20 @@ def migrate_existing_data():
         except:
             pass
         
+        # 將舊資料中未補零的請假日期（如 2025-8-5）統一為 YYYY-MM-DD，字串比較與範圍查詢才正確
+        unpadded = conn.execute('''
+            SELECT id, start_date, end_date FROM leave_schedule
+            WHERE length(start_date) != 10 OR length(end_date) != 10
+        ''').fetchall()
+        for row in unpadded:
+            try:
+                conn.execute('UPDATE leave_schedule SET start_date = ?, end_date = ? WHERE id = ?',
+                             (parse_date(row['start_date']).isoformat(), parse_date(row['end_date']).isoformat(), row['id']))
+            except ValueError:
+                print(f"請假記錄 {row['id']} 日期格式無法解析，略過")
+        
+        # 更新統計資訊，讓查詢規劃器選用上述索引
+        conn.execute('ANALYZE')
         conn.commit()
         print("資料遷移完成")
     except Exception as e:
@@ -378,7 +510,6 @@ def index():
 def staff():
     conn = get_db_connection()
     staff_list = conn.execute('SELECT * FROM staff').fetchall()
-    conn.close()
     return render_template('staff.html', staff_list=staff_list)
 
 @app.route('/shift')
@@ -414,7 +545,6 @@ def shift():
         
         processed_shifts.append(shift_dict)
     
-    conn.close()
     return render_template('shift.html', shift_list=processed_shifts)
 
 @app.route('/schedule')
@@ -479,13 +609,13 @@ def view_schedule():
     # 計算班數統計（支援日期範圍）
     staff_stats = []
     if schedule:
-        staff_count = {}
+        staff_count = defaultdict(int)
         staff_name_map = {}
         for row in schedule:
             sid = row['staff_id']
             if sid is None:
                 continue
-            staff_count[sid] = staff_count.get(sid, 0) + 1
+            staff_count[sid] += 1
             staff_name_map[sid] = row['staff_name']
         
         for sid, count in staff_count.items():
@@ -500,7 +630,6 @@ def view_schedule():
     # 取得所有員工清單（供下拉選單用）
     staff_rows = conn.execute('SELECT staff_id, name FROM staff').fetchall()
     staff_list = [dict(row) for row in staff_rows]
-    conn.close()
     return render_template('view_schedule.html', schedule=schedule, filters=filters, staff_stats=staff_stats, staff_list=staff_list)
 
 @app.route('/add_staff', methods=['POST'])
@@ -516,7 +645,6 @@ def add_staff():
         conn.commit()
     except sqlite3.IntegrityError:
         pass  # 可加上提示：員工編號重複
-    conn.close()
     return redirect(url_for('staff'))
 
 @app.route('/delete_staff', methods=['POST'])
@@ -526,7 +654,6 @@ def delete_staff():
     conn = get_db_connection()
     conn.execute('DELETE FROM staff WHERE staff_id = ?', (staff_id,))
     conn.commit()
-    conn.close()
     return redirect(url_for('staff'))
 
 @app.route('/edit_staff', methods=['POST'])
@@ -539,7 +666,6 @@ def edit_staff():
     conn = get_db_connection()
     conn.execute('UPDATE staff SET name = ?, title = ?, ward = ? WHERE staff_id = ?', (name, title, ward, staff_id))
     conn.commit()
-    conn.close()
     return redirect(url_for('staff'))
 
 @app.route('/download_staff_template')
@@ -575,7 +701,6 @@ def upload_staff():
             except sqlite3.IntegrityError:
                 pass  # 跳過重複的員工編號
     conn.commit()
-    conn.close()
     return redirect(url_for('staff'))
 
 @app.route('/add_shift', methods=['POST'])
@@ -612,7 +737,6 @@ def add_shift():
         conn.commit()
     except sqlite3.IntegrityError:
         pass
-    conn.close()
     return redirect(url_for('shift'))
 
 @app.route('/download_shift_template')
@@ -649,7 +773,6 @@ def upload_shift():
             except sqlite3.IntegrityError:
                 pass  # 跳過重複的班別編號
     conn.commit()
-    conn.close()
     return redirect(url_for('shift'))
 
 @app.route('/edit_shift', methods=['POST'])
@@ -663,7 +786,6 @@ def edit_shift():
     conn = get_db_connection()
     conn.execute('UPDATE shift SET name = ?, time = ?, required_count = ?, ward = ? WHERE shift_id = ?', (name, time, required_count, ward, shift_id))
     conn.commit()
-    conn.close()
     return redirect(url_for('shift'))
 
 @app.route('/delete_shift', methods=['POST'])
@@ -673,7 +795,6 @@ def delete_shift():
     conn = get_db_connection()
     conn.execute('DELETE FROM shift WHERE shift_id = ?', (shift_id,))
     conn.commit()
-    conn.close()
     return redirect(url_for('shift'))
 
 @app.route('/save_daily_requirements', methods=['POST'])
@@ -699,7 +820,6 @@ def save_daily_requirements():
                            (shift_id, day_of_week, count))
         
         conn.commit()
-        conn.close()
         
         return jsonify({'success': True, 'message': '每日需求人數儲存成功'})
     except Exception as e:
@@ -734,8 +854,8 @@ def auto_schedule():
         if not start_raw or not end_raw:
             flash('請選擇起始日期與結束日期', 'danger')
             return redirect(url_for('schedule'))
-        start_date_obj = datetime.strptime(start_raw, '%Y-%m-%d')
-        end_date_obj   = datetime.strptime(end_raw,   '%Y-%m-%d')
+        start_date_obj = parse_date(start_raw)
+        end_date_obj   = parse_date(end_raw)
         if start_date_obj > end_date_obj:
             flash('起始日期不能大於結束日期', 'danger')
             return redirect(url_for('schedule'))
@@ -744,11 +864,8 @@ def auto_schedule():
             return redirect(url_for('schedule'))
         
     # ---------- 統一產生 dates & months 清單 ----------
-    dates = []
-    cur = start_date_obj
-    while cur <= end_date_obj:
-        dates.append(cur.strftime('%Y-%m-%d'))
-        cur += timedelta(days=1)
+    total_days = (end_date_obj - start_date_obj).days + 1
+    dates = [(start_date_obj + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(total_days)]
     # 去重並排序月份（格式 YYYY-MM）
     months = sorted({d[:7] for d in dates})
 
@@ -789,6 +906,7 @@ def auto_schedule():
     shifts = conn.execute('SELECT * FROM shift').fetchall()
     staff  = conn.execute('SELECT * FROM staff').fetchall()
     staff_list = [dict(s) for s in staff]
+    staff_by_id = {s['staff_id']: s for s in staff_list}
     
     # 建立每日需求人數字典
     daily_requirements = {}
@@ -808,7 +926,7 @@ def auto_schedule():
             'consecutive':     0,
             'last_date':       None,
             'last_worked':     False,
-            'shift_counts':    {},
+            'shift_counts':    defaultdict(int),
             'night_count':     0,
             'night_consecutive': 0,
             'last_night_date':   None,
@@ -850,13 +968,12 @@ def auto_schedule():
     end_date = dates[-1] if dates else None
     
     if start_date and end_date:
+        dates_set = set(dates)
         allocations = conn.execute('''
             SELECT * FROM night_shift_allocation 
-            WHERE (start_date <= ? AND end_date >= ?) OR 
-                  (start_date >= ? AND start_date <= ?) OR
-                  (end_date >= ? AND end_date <= ?)
+            WHERE start_date <= ? AND end_date >= ?
             ORDER BY start_date, staff_id
-        ''', (end_date, start_date, start_date, end_date, start_date, end_date)).fetchall()
+        ''', (end_date, start_date)).fetchall()
         
         for allocation in allocations:
             alloc_start = allocation['start_date']
@@ -865,24 +982,18 @@ def auto_schedule():
             shift_id = allocation['shift_id']
             
             # 為該分配範圍內的每一天建立記錄
-            current_date = datetime.strptime(alloc_start, '%Y-%m-%d')
-            end_date_obj = datetime.strptime(alloc_end, '%Y-%m-%d')
+            alloc_start_obj = parse_date(alloc_start)
+            alloc_days = (parse_date(alloc_end) - alloc_start_obj).days + 1
             
-            while current_date <= end_date_obj:
-                date_str = current_date.strftime('%Y-%m-%d')
+            for offset in range(alloc_days):
+                date_str = (alloc_start_obj + timedelta(days=offset)).strftime('%Y-%m-%d')
                 
                 # 只處理在排班日期範圍內的日期
-                if date_str in dates:
-                    if date_str not in night_shift_allocations:
-                        night_shift_allocations[date_str] = []
-                    night_shift_allocations[date_str].append((staff_id, shift_id))
-                
-                current_date += timedelta(days=1)
+                if date_str in dates_set:
+                    night_shift_allocations.setdefault(date_str, []).append((staff_id, shift_id))
 
     # ---------- 清除舊排班 ----------
-    for m in months:
-        conn.execute('DELETE FROM schedule           WHERE date LIKE ?', (f"{m}%",))
-        conn.execute('DELETE FROM weekly_work_stats WHERE month = ?',     (m,))
+    clear_months_schedule(conn, months)
 
     now_str  = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     operator = session.get('username', 'system')
@@ -890,6 +1001,7 @@ def auto_schedule():
 
 
     # ---------- 計算每週例假與休息日 ----------
+    weekdays = consecutive_weekdays(dates)  # 每日星期（0=週一 ... 6=週日）
     staff_holidays = {s['staff_id']: {} for s in staff_list}
     staff_restdays = {s['staff_id']: {} for s in staff_list}
     
@@ -898,10 +1010,9 @@ def auto_schedule():
         for w in range(1, total_weeks + 1):  # 需要縮排
             start_idx = (w-1)*7
             end_idx = min(w*7, len(dates))
-            week_dates = dates[start_idx : end_idx]
-            for d in week_dates:
-                if datetime.strptime(d, '%Y-%m-%d').weekday() == 6:
-                    staff_holidays[sid][w] = d
+            for i in range(start_idx, end_idx):
+                if weekdays[i] == 6:
+                    staff_holidays[sid][w] = dates[i]
                     break
 
     # 休息日（週一到週六隨機）
@@ -909,19 +1020,40 @@ def auto_schedule():
         for w in range(1, total_weeks + 1):
             start_idx = (w-1)*7
             end_idx = min(w*7, len(dates))  # 避免超出範圍
-            week_dates = dates[start_idx : end_idx]
-            choices = [d for d in week_dates if datetime.strptime(d, '%Y-%m-%d').weekday() < 6]
+            choices = [dates[i] for i in range(start_idx, end_idx) if weekdays[i] < 6]
             if choices:
                 staff_restdays[sid][w] = random.choice(choices)
 
+    # ---------- 一次讀取排班範圍內的請假 ----------
+    leave_dates = load_leave_dates(conn, dates)
+    schedule_rows = []  # 排班結果先收集，最後以 executemany 一次寫入
+
+    # ---------- 班別分組（與日期無關，先分好） ----------
+    night_shifts = [shift for shift in shifts if '大夜' in shift['name']]
+    day_shifts = [shift for shift in shifts if '大夜' not in shift['name']]
+    night_shift_ids = {shift['shift_id'] for shift in night_shifts}
+
     # ---------- 主迴圈：每日排班 ----------
     for idx, date in enumerate(dates):
-        date_obj     = datetime.strptime(date, '%Y-%m-%d')
+        date_month   = date[:7]  # 取得日期的年-月部分
         week_of_month = (idx // 7) + 1
-        dow           = date_obj.weekday() + 1
+        dow           = weekdays[idx] + 1
         is_holiday    = (dow == holiday_day)
+        # 例假日出勤限制只取決於固定參數與當日，先合併成單一旗標
+        limit_holiday_work = is_flexible_workweek and require_holiday and is_holiday
         worked_today  = set()
 
+        # 當日各病房可排人員：先排除請假、例假與休息日，班別迴圈只需再檢查隨指派變動的限制
+        day_pool_by_ward   = defaultdict(list)  # 非大夜班
+        night_pool_by_ward = defaultdict(list)  # 大夜班（不受例假與休息日限制）
+        for s in staff_list:
+            sid = s['staff_id']
+            if date in leave_dates.get(sid, ()):
+                continue  # 該員工在此日期有請假
+            night_pool_by_ward[s['ward']].append(s)
+            if staff_holidays[sid].get(week_of_month) != date and staff_restdays[sid].get(week_of_month) != date:
+                day_pool_by_ward[s['ward']].append(s)
+
         # ---------- 星期日 On Call 處理 ----------
         if dow == 7:  # 星期日（只有星期天安排 On Call）
             # 檢查是否已有 On Call 設定
@@ -931,26 +1063,21 @@ def auto_schedule():
             
             if not existing_oncall:
                 # 計算每位員工的 On Call 次數（本月）
-                current_month = date[:7]
+                # 以日期範圍（可用索引）取代 date LIKE 'YYYY-MM%'，一次查出全部員工
+                month_oncall_counts = dict(conn.execute(
+                    'SELECT staff_id, COUNT(*) FROM oncall_schedule WHERE date >= ? AND date < ? GROUP BY staff_id',
+                    month_date_range(date_month)
+                ).fetchall())
                 oncall_counts = {}
                 for s in staff_list:
                     # 檢查該員工是否在此星期天請假
-                    leave_check = conn.execute('''
-                        SELECT COUNT(*) FROM leave_schedule 
-                        WHERE staff_id = ? AND start_date <= ? AND end_date >= ? AND approved = 1
-                    ''', (s['staff_id'], date, date)).fetchone()[0]
-                    
-                    if leave_check == 0:  # 沒有請假才納入 On Call 候選
-                        count = conn.execute(
-                            'SELECT COUNT(*) FROM oncall_schedule WHERE staff_id = ? AND date LIKE ?',
-                            (s['staff_id'], f"{current_month}%")
-                        ).fetchone()[0]
-                        oncall_counts[s['staff_id']] = count
+                    if date not in leave_dates.get(s['staff_id'], ()):  # 沒有請假才納入 On Call 候選
+                        oncall_counts[s['staff_id']] = month_oncall_counts.get(s['staff_id'], 0)
                 
                 # 選擇 On Call 次數最少的員工（排除請假員工）
                 if oncall_counts:
                     min_count = min(oncall_counts.values())
-                    candidates = [s for s in staff_list if oncall_counts.get(s['staff_id'], float('inf')) == min_count]
+                    candidates = [staff_by_id[sid] for sid, count in oncall_counts.items() if count == min_count]
                     
                     if candidates:
                         oncall_staff = random.choice(candidates)
@@ -965,21 +1092,14 @@ def auto_schedule():
                     print(f"警告：{date} 星期日無法安排 On Call，所有員工都在請假")
 
         # 重新排序班別：大夜班優先處理（特別是有預先分配的）
-        shifts_ordered = []
-        night_shifts_with_allocation = []
-        other_shifts = []
-        
-        for shift in shifts:
-            is_night = '大夜' in shift['name']
-            if is_night and date in night_shift_allocations:
-                # 有預先分配的大夜班最優先
-                night_shifts_with_allocation.append(shift)
-            elif is_night:
-                # 其他大夜班次之
-                other_shifts.insert(0, shift)
-            else:
-                # 非大夜班最後
-                other_shifts.append(shift)
+        if date in night_shift_allocations:
+            # 有預先分配的大夜班最優先
+            night_shifts_with_allocation = night_shifts
+            other_shifts = day_shifts
+        else:
+            # 其他大夜班次之（反序，與原本逐一插入最前方一致），非大夜班最後
+            night_shifts_with_allocation = []
+            other_shifts = night_shifts[::-1] + day_shifts
         
         shifts_ordered = night_shifts_with_allocation + other_shifts
         
@@ -992,7 +1112,7 @@ def auto_schedule():
             sid_shift  = shift['shift_id']
             required   = daily_requirements[sid_shift][dow]
             ward       = shift['ward']
-            is_night   = '大夜' in shift['name']
+            is_night   = sid_shift in night_shift_ids
             candidates = []
             
             # 檢查是否有大夜班預先分配
@@ -1005,7 +1125,7 @@ def auto_schedule():
                 for staff_id, allocated_shift_id in night_allocations:
                     if allocated_shift_id == sid_shift:
                         # 找到對應的員工
-                        allocated_staff = next((s for s in staff_list if s['staff_id'] == staff_id), None)
+                        allocated_staff = staff_by_id.get(staff_id)
                         if allocated_staff and allocated_staff['ward'] == ward:
                             st = staff_status[staff_id]
                             
@@ -1028,8 +1148,8 @@ def auto_schedule():
 
                         # 更新狀態
                         st['count'] += 1
-                        st['shift_counts'][sid_shift] = st['shift_counts'].get(sid_shift, 0) + 1
-                        st['shift_counts'][date]     = st['shift_counts'].get(date, 0)     + 1
+                        st['shift_counts'][sid_shift] += 1
+                        st['shift_counts'][date]     += 1
                         st['last_date']   = date
                         st['last_worked'] = True
                         st[f'week{week_of_month}_count'] += 1
@@ -1041,39 +1161,25 @@ def auto_schedule():
                         # 更新週班別追蹤
                         st['weekly_shifts'][week_of_month].add(sid_shift)
 
-                        # 寫入 schedule
-                        conn.execute(
-                            '''INSERT INTO schedule
-                               (date, shift_id, staff_id, work_hours, is_auto, operator_id, created_at, updated_at)
-                               VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                            (date, sid_shift, sid, 8, 1, operator, now_str, now_str)
-                        )
+                        # 暫存 schedule 資料，最後一次寫入
+                        schedule_rows.append((date, sid_shift, sid, 8, 1, operator, now_str, now_str))
                         worked_today.add(sid)
                     
                     # 大夜班預先分配已完成，跳到下一個班別
                     continue
                         
                         # 篩選可用員工（排除已預先分配的員工）
-            for s in staff_list:
+            eligible_staff = (night_pool_by_ward if is_night else day_pool_by_ward).get(ward, ())
+            for s in eligible_staff:
                 sid = s['staff_id']
-                if s['ward'] != ward:
-                    continue
                 # 跳過已經在預先分配中的員工，避免重複
                 if sid in pre_allocated_staff_ids:
                     continue
                 st = staff_status[sid]
-
-                # 🚨 第一優先：請假檢查 - 如果該員工在此日期請假，則跳過
-                leave_check = conn.execute('''
-                    SELECT COUNT(*) FROM leave_schedule 
-                    WHERE staff_id = ? AND start_date <= ? AND end_date >= ? AND approved = 1
-                ''', (sid, date, date)).fetchone()[0]
-                
-                if leave_check > 0:
-                    continue  # 該員工在此日期有請假，跳過
+                shift_counts = st['shift_counts']  # 迴圈內多次使用，先取出
+                count = st['count']
 
                 # 偏好檢查 - 根據日期月份查找偏好設定
-                date_month = date[:7]  # 取得日期的年-月部分
                 pref = preferences.get((sid, date_month))
                 if pref:
                     if pref['type'] == 'single':
@@ -1090,32 +1196,24 @@ def auto_schedule():
                                 if sid_shift != pref['shift_id_2']:
                                     continue
                         elif pref['week_pattern'] == 'consecutive':
-                            main_shift_count = st['shift_counts'].get(pref['shift_id_1'], 0)
-                            secondary_shift_count = st['shift_counts'].get(pref['shift_id_2'], 0)
+                            main_shift_count = shift_counts.get(pref['shift_id_1'], 0)
+                            secondary_shift_count = shift_counts.get(pref['shift_id_2'], 0)
                             if main_shift_count <= secondary_shift_count:
                                 if sid_shift != pref['shift_id_1']:
                                     continue
                             else:
                                 if sid_shift != pref['shift_id_2']:
                                     continue
-                
-                                # 節假日與休息日檢查
-                if not is_night:
-                    if staff_holidays[sid].get(week_of_month) == date:
-                        continue
-                    if staff_restdays[sid].get(week_of_month) == date:
-                        continue
 
                 # 次數、工時、間隔等檢查（與原邏輯相同）
-                if st['count'] >= max_per_month:
+                if count >= max_per_month:
                     continue
-                if st['shift_counts'].get(date, 0) >= max_per_day:
+                if shift_counts.get(date, 0) >= max_per_day:
+                    continue
+                if is_flexible_workweek and st['weekly_hours'][week_of_month] >= 40:
+                    continue
+                if limit_holiday_work and st['holiday_days'][week_of_month] > 0:
                     continue
-                if is_flexible_workweek:
-                    if st['weekly_hours'][week_of_month] >= 40:
-                        continue
-                    if require_holiday and is_holiday and st['holiday_days'][week_of_month] > 0:
-                        continue
 
                 # 週班別一致性評分
                 week_consistency_score = 0
@@ -1130,32 +1228,35 @@ def auto_schedule():
                     else:
                         week_consistency_score = 0  # 本週還沒排班，所有班別平等
 
-                candidates.append((s, st['count'], st['shift_counts'].get(sid_shift, 0), week_consistency_score))
+                candidates.append((s, count, shift_counts.get(sid_shift, 0), week_consistency_score))
 
-            # 排序候選人
-            if fair_distribution:
-                if week_shift_consistency:
-                    # 考慮週班別一致性的排序：預先分配 > 偏好設定 > 週班別一致性 > 總班數 > 該班別次數
-                    candidates.sort(key=lambda c: (
-                        0 if c[3] == -1 else 1,  # 預先分配最優先
-                        0 if preferences.get((c[0]['staff_id'], date_month)) else 1,  # 偏好設定優先
-                        c[3] if c[3] != -1 else 0,  # 週班別一致性評分
-                        c[1],  # 總班數
-                        c[2]   # 該班別次數
-                    ))
+            # 排序候選人（候選人超過需求時才需要挑選前 required 名）
+            if 0 < required < len(candidates):
+                if fair_distribution:
+                    # 只取前 required 名，以 heapq.nsmallest 取代完整排序
+                    if week_shift_consistency:
+                        # 考慮週班別一致性的排序：預先分配 > 偏好設定 > 週班別一致性 > 總班數 > 該班別次數
+                        candidates = heapq.nsmallest(required, candidates, key=lambda c: (
+                            0 if c[3] == -1 else 1,  # 預先分配最優先
+                            0 if preferences.get((c[0]['staff_id'], date_month)) else 1,  # 偏好設定優先
+                            c[3] if c[3] != -1 else 0,  # 週班別一致性評分
+                            c[1],  # 總班數
+                            c[2]   # 該班別次數
+                        ))
+                    else:
+                        candidates = heapq.nsmallest(required, candidates, key=lambda c: (
+                            0 if c[3] == -1 else 1,  # 預先分配最優先
+                            0 if preferences.get((c[0]['staff_id'], date_month)) else 1, 
+                            c[1], 
+                            c[2]
+                        ))
                 else:
-                    candidates.sort(key=lambda c: (
-                        0 if c[3] == -1 else 1,  # 預先分配最優先
-                        0 if preferences.get((c[0]['staff_id'], date_month)) else 1, 
-                        c[1], 
-                        c[2]
-                    ))
-            else:
-                # 保留原本隨機但分組邏輯，但預先分配仍然優先
-                pre_allocated = [c for c in candidates if c[3] == -1]
-                others = [c for c in candidates if c[3] != -1]
-                random.shuffle(others)
-                candidates = pre_allocated + others
+                    # 保留原本隨機但分組邏輯，但預先分配仍然優先
+                    pre_allocated = [c for c in candidates if c[3] == -1]
+                    others = [c for c in candidates if c[3] != -1]
+                    # 只隨機抽出補足需求所需的人數，不必打亂整個名單
+                    need = max(0, required - len(pre_allocated))
+                    candidates = pre_allocated + random.sample(others, min(need, len(others)))
 
             # 指派
             assigned = candidates[:required]
@@ -1166,8 +1267,8 @@ def auto_schedule():
                 
                 # 更新狀態
                 st['count'] += 1
-                st['shift_counts'][sid_shift] = st['shift_counts'].get(sid_shift, 0) + 1
-                st['shift_counts'][date]     = st['shift_counts'].get(date, 0)     + 1
+                st['shift_counts'][sid_shift] += 1
+                st['shift_counts'][date]     += 1
                 st['last_date']   = date
                 st['last_worked'] = True
                 st[f'week{week_of_month}_count'] += 1
@@ -1179,24 +1280,14 @@ def auto_schedule():
                 # 更新週班別追蹤
                 st['weekly_shifts'][week_of_month].add(sid_shift)
             
-                # 寫入 schedule
-                conn.execute(
-                    '''INSERT INTO schedule
-                       (date, shift_id, staff_id, work_hours, is_auto, operator_id, created_at, updated_at)
-                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                    (date, sid_shift, sid, 8, 1, operator, now_str, now_str)
-                )
+                # 暫存 schedule 資料，最後一次寫入
+                schedule_rows.append((date, sid_shift, sid, 8, 1, operator, now_str, now_str))
                 worked_today.add(sid)
 
             # 自動填補缺員
             if auto_fill_missing and len(assigned) < required:
                 for _ in range(required - len(assigned)):
-                    conn.execute(
-                        '''INSERT INTO schedule
-                           (date, shift_id, staff_id, work_hours, is_auto, operator_id, created_at, updated_at)
-                           VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                        (date, sid_shift, '缺人值班', 8, 1, operator, now_str, now_str)
-                    )
+                    schedule_rows.append((date, sid_shift, '缺人值班', 8, 1, operator, now_str, now_str))
         
         # 當日未上班者累 rest_days
         if not is_holiday:
@@ -1206,38 +1297,44 @@ def auto_schedule():
                     staff_status[sid]['rest_days'][week_of_month] += 1
 
     # ---------- 儲存週工時統計 ----------
+    # 決定每週的統計月份（與員工無關，先算好）- 使用該週第一個日期來判斷月份
+    stats_month_by_week = {}
+    for w in range(1, total_weeks + 1):
+        start_idx = (w-1)*7
+        end_idx = min(w*7, len(dates))
+        week_dates = dates[start_idx : end_idx]
+        # 備用方案：使用第一個月份
+        stats_month_by_week[w] = week_dates[0][:7] if week_dates else months[0]
+    
+    weekly_stats_rows = []
     for sid, st in staff_status.items():
         for w in range(1, total_weeks + 1):
-            # 決定該週的統計月份 - 根據實際日期計算
-            start_idx = (w-1)*7
-            end_idx = min(w*7, len(dates))
-            week_dates = dates[start_idx : end_idx]
-            
-            if week_dates:
-                # 使用該週第一個日期來判斷月份
-                first_date = datetime.strptime(week_dates[0], '%Y-%m-%d')
-                stats_month = first_date.strftime('%Y-%m')
-            else:
-                # 備用方案：使用第一個月份
-                stats_month = months[0]
+            stats_month = stats_month_by_week[w]
             
-            conn.execute(
-                '''INSERT INTO weekly_work_stats
-                   (staff_id, month, week_number, total_hours, holiday_count, rest_day_count, work_days)
-                   VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                (
-                    sid,
-                    stats_month,
-                    w,
-                    st['weekly_hours'][w],
-                    st['holiday_days'][w],
-                    st['rest_days'][w],
-                    st['worked_days'][w]
-                )
-            )
-
+            weekly_stats_rows.append((
+                sid,
+                stats_month,
+                w,
+                st['weekly_hours'][w],
+                st['holiday_days'][w],
+                st['rest_days'][w],
+                st['worked_days'][w]
+            ))
+
+    # ---------- 批次寫入排班與週工時統計（同一個交易） ----------
+    conn.executemany(
+        '''INSERT INTO schedule
+           (date, shift_id, staff_id, work_hours, is_auto, operator_id, created_at, updated_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+        schedule_rows
+    )
+    conn.executemany(
+        '''INSERT INTO weekly_work_stats
+           (staff_id, month, week_number, total_hours, holiday_count, rest_day_count, work_days)
+           VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        weekly_stats_rows
+    )
     conn.commit()
-    conn.close()
 
     # 驗證排班結果是否符合需求
     print("🔍 開始驗證排班結果...")
@@ -1271,65 +1368,79 @@ def auto_schedule_with_validation():
     max_retries = 10  # 最大重試次數
     retry_count = 0
     
+    # 讀取表單參數與排班基礎資料（每次重試都相同，只需準備一次）
+    try:
+        month = request.form.get('month', '')
+        start_date = request.form.get('start_date', '')
+        end_date = request.form.get('end_date', '')
+        
+        # 自動偵測模式
+        if start_date and end_date:
+            # 自訂日期範圍模式
+            start_obj = parse_date(start_date)
+            end_obj = parse_date(end_date)
+            total_days = (end_obj - start_obj).days + 1
+            dates = [(start_obj + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(total_days)]
+            months = list(set([d[:7] for d in dates]))
+            total_weeks = math.ceil(len(dates) / 7)
+        else:
+            # 整月模式
+            year, mon = map(int, month.split('-'))
+            days_in_month = monthrange(year, mon)[1]
+            dates = [f"{year}-{mon:02d}-{day:02d}" for day in range(1, days_in_month+1)]
+            months = [month]
+            total_weeks = math.ceil(days_in_month / 7)
+        
+        # 其他參數
+        max_per_day = int(request.form.get('max_per_day', 1))
+        max_consecutive = int(request.form.get('max_consecutive', 5))
+        min_per_month = int(request.form.get('min_per_month', 22))
+        max_per_month = int(request.form.get('max_per_month', 30))
+        max_night_consecutive = int(request.form.get('max_night_consecutive', 2))
+        max_night_per_month = int(request.form.get('max_night_per_month', 8))
+        auto_fill_missing = (request.form.get('auto_fill_missing', 'yes') == 'yes')
+        fair_distribution = (request.form.get('fair_distribution', 'yes') == 'yes')
+        special_preference = (request.form.get('special_preference', 'no') == 'yes')
+        is_flexible_workweek = (request.form.get('is_flexible_workweek', 'yes') == 'yes')
+        require_holiday = (request.form.get('require_holiday', 'yes') == 'yes')
+        require_rest_day = (request.form.get('require_rest_day', 'yes') == 'yes')
+        holiday_day = int(request.form.get('holiday_day', 7))
+        week_shift_consistency = (request.form.get('week_shift_consistency', 'yes') == 'yes')
+        
+        # 強制啟用關鍵設定以提高通過驗證的機率
+        week_shift_consistency = True  # 強制啟用週班別一致性
+        require_holiday = True  # 強制啟用例假日
+        require_rest_day = True  # 強制啟用休息日
+        
+        schedule_ctx = build_schedule_context(dates, months, total_weeks)
+    except Exception as e:
+        print(f"❌ 排班參數讀取失敗：{str(e)}")
+        return jsonify({
+            'success': False,
+            'message': '排班失敗：無法讀取排班參數或基礎資料',
+            'error': str(e),
+            'retry_count': retry_count
+        })
+    
+    # 每次請求取一個新的基礎種子並記錄，各次嘗試以 基礎種子 + 嘗試次數 建立獨立亂數產生器，
+    # 不重設全域 random，需要時可依記錄重現結果
+    base_seed = random.randrange(2 ** 32)
+    print(f"🎲 本次排班基礎亂數種子：{base_seed}")
+    
     while retry_count < max_retries:
         retry_count += 1
         print(f"🔄 第 {retry_count} 次排班嘗試...")
+        rng = random.Random(base_seed + retry_count)
         
         # 執行自動排班邏輯（復用原有邏輯）
         try:
-            # 讀取表單參數
-            month = request.form.get('month', '')
-            start_date = request.form.get('start_date', '')
-            end_date = request.form.get('end_date', '')
-            
-            # 自動偵測模式
-            if start_date and end_date:
-                # 自訂日期範圍模式
-                start_obj = datetime.strptime(start_date, '%Y-%m-%d')
-                end_obj = datetime.strptime(end_date, '%Y-%m-%d')
-                dates = []
-                current_date = start_obj
-                while current_date <= end_obj:
-                    dates.append(current_date.strftime('%Y-%m-%d'))
-                    current_date += timedelta(days=1)
-                months = list(set([d[:7] for d in dates]))
-                total_weeks = math.ceil(len(dates) / 7)
-            else:
-                # 整月模式
-                year, mon = map(int, month.split('-'))
-                days_in_month = monthrange(year, mon)[1]
-                dates = [f"{year}-{mon:02d}-{day:02d}" for day in range(1, days_in_month+1)]
-                months = [month]
-                total_weeks = math.ceil(days_in_month / 7)
-            
-            # 其他參數
-            max_per_day = int(request.form.get('max_per_day', 1))
-            max_consecutive = int(request.form.get('max_consecutive', 5))
-            min_per_month = int(request.form.get('min_per_month', 22))
-            max_per_month = int(request.form.get('max_per_month', 30))
-            max_night_consecutive = int(request.form.get('max_night_consecutive', 2))
-            max_night_per_month = int(request.form.get('max_night_per_month', 8))
-            auto_fill_missing = (request.form.get('auto_fill_missing', 'yes') == 'yes')
-            fair_distribution = (request.form.get('fair_distribution', 'yes') == 'yes')
-            special_preference = (request.form.get('special_preference', 'no') == 'yes')
-            is_flexible_workweek = (request.form.get('is_flexible_workweek', 'yes') == 'yes')
-            require_holiday = (request.form.get('require_holiday', 'yes') == 'yes')
-            require_rest_day = (request.form.get('require_rest_day', 'yes') == 'yes')
-            holiday_day = int(request.form.get('holiday_day', 7))
-            week_shift_consistency = (request.form.get('week_shift_consistency', 'yes') == 'yes')
-            
-            # 強制啟用關鍵設定以提高通過驗證的機率
-            week_shift_consistency = True  # 強制啟用週班別一致性
-            require_holiday = True  # 強制啟用例假日
-            require_rest_day = True  # 強制啟用休息日
-            
             # 調用原有的自動排班邏輯（簡化版本，直接導向核心邏輯）
             result = execute_auto_schedule_logic(
-                dates, months, total_weeks, max_per_day, max_consecutive,
+                schedule_ctx, max_per_day, max_consecutive,
                 min_per_month, max_per_month, max_night_consecutive, max_night_per_month,
                 auto_fill_missing, fair_distribution, special_preference,
                 is_flexible_workweek, require_holiday, require_rest_day, holiday_day,
-                week_shift_consistency
+                week_shift_consistency, rng
             )
             
             if result['success']:
@@ -1358,30 +1469,17 @@ def auto_schedule_with_validation():
         'retry_count': retry_count
     })
 
-def execute_auto_schedule_logic(dates, months, total_weeks, max_per_day, max_consecutive,
-                              min_per_month, max_per_month, max_night_consecutive, max_night_per_month,
-                              auto_fill_missing, fair_distribution, special_preference,
-                              is_flexible_workweek, require_holiday, require_rest_day, holiday_day,
-                              week_shift_consistency):
+def build_schedule_context(dates, months, total_weeks):
     """
-    執行自動排班核心邏輯，返回結果字典
-    這是對原有 auto_schedule 函數的簡化版本，專門用於驗證重新生成
+    讀取排班所需的唯讀資料（班別、員工、每日需求、大夜班預先分配），
+    供 auto_schedule_with_validation 在多次重試間共用
     """
-    import random
-    
     conn = get_db_connection()
-    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    operator = session.get('username', 'system')
-    
-    # 清除舊排班
-    for m in months:
-        conn.execute('DELETE FROM schedule WHERE date LIKE ?', (f"{m}%",))
-        conn.execute('DELETE FROM weekly_work_stats WHERE month = ?', (m,))
-    
     # 讀取資料
     shifts = conn.execute('SELECT * FROM shift').fetchall()
     staff = conn.execute('SELECT * FROM staff').fetchall()
     staff_list = [dict(s) for s in staff]
+    staff_by_id = {s['staff_id']: s for s in staff_list}
     
     # 建立每日需求人數字典
     daily_requirements = {}
@@ -1401,13 +1499,12 @@ def execute_auto_schedule_logic(dates, months, total_weeks, max_per_day, max_con
     end_date = dates[-1] if dates else None
     
     if start_date and end_date:
+        dates_set = set(dates)
         allocations = conn.execute('''
             SELECT * FROM night_shift_allocation 
-            WHERE (start_date <= ? AND end_date >= ?) OR 
-                  (start_date >= ? AND start_date <= ?) OR
-                  (end_date >= ? AND end_date <= ?)
+            WHERE start_date <= ? AND end_date >= ?
             ORDER BY start_date, staff_id
-        ''', (end_date, start_date, start_date, end_date, start_date, end_date)).fetchall()
+        ''', (end_date, start_date)).fetchall()
         
         for allocation in allocations:
             alloc_start = allocation['start_date']
@@ -1415,22 +1512,65 @@ def execute_auto_schedule_logic(dates, months, total_weeks, max_per_day, max_con
             staff_id = allocation['staff_id']
             shift_id = allocation['shift_id']
             
-            current_date = datetime.strptime(alloc_start, '%Y-%m-%d')
-            end_date_obj = datetime.strptime(alloc_end, '%Y-%m-%d')
+            alloc_start_obj = parse_date(alloc_start)
+            alloc_days = (parse_date(alloc_end) - alloc_start_obj).days + 1
             
-            while current_date <= end_date_obj:
-                date_str = current_date.strftime('%Y-%m-%d')
-                if date_str in dates:
-                    if date_str not in night_shift_allocations:
-                        night_shift_allocations[date_str] = []
-                    night_shift_allocations[date_str].append((staff_id, shift_id))
-                current_date += timedelta(days=1)
+            for offset in range(alloc_days):
+                date_str = (alloc_start_obj + timedelta(days=offset)).strftime('%Y-%m-%d')
+                if date_str in dates_set:
+                    night_shift_allocations.setdefault(date_str, []).append((staff_id, shift_id))
+    
+    # 讀取排班範圍內的請假
+    leave_dates = load_leave_dates(conn, dates)
+    
+    return {
+        'dates': dates,
+        'weekdays': consecutive_weekdays(dates),
+        'months': months,
+        'total_weeks': total_weeks,
+        'shifts': shifts,
+        'staff_list': staff_list,
+        'staff_by_id': staff_by_id,
+        'daily_requirements': daily_requirements,
+        'night_shift_allocations': night_shift_allocations,
+        'leave_dates': leave_dates,
+    }
+
+def execute_auto_schedule_logic(schedule_ctx, max_per_day, max_consecutive,
+                              min_per_month, max_per_month, max_night_consecutive, max_night_per_month,
+                              auto_fill_missing, fair_distribution, special_preference,
+                              is_flexible_workweek, require_holiday, require_rest_day, holiday_day,
+                              week_shift_consistency, rng):
+    """
+    執行自動排班核心邏輯，返回結果字典
+    這是對原有 auto_schedule 函數的簡化版本，專門用於驗證重新生成
+    schedule_ctx 由 build_schedule_context 建立，於各次重試間共用
+    rng 為此次嘗試專用的 random.Random，不影響全域亂數狀態
+    """
+    dates = schedule_ctx['dates']
+    weekdays = schedule_ctx['weekdays']
+    months = schedule_ctx['months']
+    total_weeks = schedule_ctx['total_weeks']
+    shifts = schedule_ctx['shifts']
+    staff_list = schedule_ctx['staff_list']
+    staff_by_id = schedule_ctx['staff_by_id']
+    daily_requirements = schedule_ctx['daily_requirements']
+    night_shift_allocations = schedule_ctx['night_shift_allocations']
+    leave_dates = schedule_ctx['leave_dates']
+    
+    conn = get_db_connection()
+    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    operator = session.get('username', 'system')
+    
+    # 清除舊排班
+    clear_months_schedule(conn, months)
+    schedule_rows = []  # 排班結果先收集，最後以 executemany 一次寫入
     
     # 簡化的排班邏輯：隨機分配但滿足基本約束
     staff_status = {
         s['staff_id']: {
             'count': 0,
-            'shift_counts': {},
+            'shift_counts': defaultdict(int),
             'weekly_shifts': {w: set() for w in range(1, total_weeks + 1)},
             'weekly_hours': {w: 0 for w in range(1, total_weeks + 1)},
             'holiday_days': {w: 0 for w in range(1, total_weeks + 1)},
@@ -1448,45 +1588,52 @@ def execute_auto_schedule_logic(dates, months, total_weeks, max_per_day, max_con
         for w in range(1, total_weeks + 1):  # 需要縮排
             start_idx = (w-1)*7
             end_idx = min(w*7, len(dates))
-            week_dates = dates[start_idx : end_idx]
             # 週日例假
-            for d in week_dates:
-                if datetime.strptime(d, '%Y-%m-%d').weekday() == 6:
-                    staff_holidays[sid][w] = d
+            for i in range(start_idx, end_idx):
+                if weekdays[i] == 6:
+                    staff_holidays[sid][w] = dates[i]
                     break
             # 週一到週六隨機休息日
-            choices = [d for d in week_dates if datetime.strptime(d, '%Y-%m-%d').weekday() < 6]
+            choices = [dates[i] for i in range(start_idx, end_idx) if weekdays[i] < 6]
             if choices:
-                staff_restdays[sid][w] = random.choice(choices)
+                staff_restdays[sid][w] = rng.choice(choices)
+    
+    # 班別分組（與日期無關，先分好）
+    night_shifts = [shift for shift in shifts if '大夜' in shift['name']]
+    day_shifts = [shift for shift in shifts if '大夜' not in shift['name']]
+    night_shift_ids = {shift['shift_id'] for shift in night_shifts}
     
     # 每日排班
     for idx, date in enumerate(dates):
-        date_obj = datetime.strptime(date, '%Y-%m-%d')
         week_of_month = (idx // 7) + 1
-        dow = date_obj.weekday() + 1
+        dow = weekdays[idx] + 1
         worked_today = set()
         
-        # 班別處理順序：大夜班優先
-        shifts_ordered = []
-        night_shifts_with_allocation = []
-        other_shifts = []
-        
-        for shift in shifts:
-            is_night = '大夜' in shift['name']
-            if is_night and date in night_shift_allocations:
-                night_shifts_with_allocation.append(shift)
-            elif is_night:
-                other_shifts.insert(0, shift)
-            else:
-                other_shifts.append(shift)
+        # 當日各病房可排人員：先排除請假、例假與休息日，班別迴圈只需再檢查隨指派變動的限制
+        day_pool_by_ward = defaultdict(list)  # 非大夜班
+        night_pool_by_ward = defaultdict(list)  # 大夜班（不受例假限制，但仍保留休息日）
+        for s in staff_list:
+            sid = s['staff_id']
+            if date in leave_dates.get(sid, ()):
+                continue  # 該員工在此日期有請假
+            # 每週至少保留一天平日休息日（與 validate_schedule_requirements 一致）
+            if staff_restdays[sid].get(week_of_month) == date:
+                continue
+            night_pool_by_ward[s['ward']].append(s)
+            if staff_holidays[sid].get(week_of_month) != date:
+                day_pool_by_ward[s['ward']].append(s)
         
-        shifts_ordered = night_shifts_with_allocation + other_shifts
+        # 班別處理順序：大夜班優先
+        if date in night_shift_allocations:
+            shifts_ordered = night_shifts + day_shifts
+        else:
+            shifts_ordered = night_shifts[::-1] + day_shifts
         
         for shift in shifts_ordered:
             sid_shift = shift['shift_id']
             required = daily_requirements[sid_shift][dow]
             ward = shift['ward']
-            is_night = '大夜' in shift['name']
+            is_night = sid_shift in night_shift_ids
             candidates = []
             
             # 處理大夜班預先分配
@@ -1496,7 +1643,7 @@ def execute_auto_schedule_logic(dates, months, total_weeks, max_per_day, max_con
             if is_night and night_allocations:
                 for staff_id, allocated_shift_id in night_allocations:
                     if allocated_shift_id == sid_shift:
-                        allocated_staff = next((s for s in staff_list if s['staff_id'] == staff_id), None)
+                        allocated_staff = staff_by_id.get(staff_id)
                         if allocated_staff and allocated_staff['ward'] == ward:
                             st = staff_status[staff_id]
                             if st['shift_counts'].get(date, 0) < max_per_day:
@@ -1508,50 +1655,42 @@ def execute_auto_schedule_logic(dates, months, total_weeks, max_per_day, max_con
                 assigned = candidates[:required]
             else:
                 # 篩選其他可用員工
-                for s in staff_list:
+                eligible_staff = (night_pool_by_ward if is_night else day_pool_by_ward).get(ward, ())
+                for s in eligible_staff:
                     sid = s['staff_id']
-                    if s['ward'] != ward or sid in pre_allocated_staff_ids:
+                    if sid in pre_allocated_staff_ids:
                         continue
                     
                     st = staff_status[sid]
-                    
-                    # 🚨 第一優先：請假檢查 - 如果該員工在此日期請假，則跳過
-                    leave_check = conn.execute('''
-                        SELECT COUNT(*) FROM leave_schedule 
-                        WHERE staff_id = ? AND start_date <= ? AND end_date >= ? AND approved = 1
-                    ''', (sid, date, date)).fetchone()[0]
-                    
-                    if leave_check > 0:
-                        continue  # 該員工在此日期有請假，跳過
+                    shift_counts = st['shift_counts']  # 迴圈內多次使用，先取出
                     
                     # 基本約束檢查
-                    if st['shift_counts'].get(date, 0) >= max_per_day:
+                    if shift_counts.get(date, 0) >= max_per_day:
                         continue
-                    if not is_night:
-                        if staff_holidays[sid].get(week_of_month) == date:
-                            continue
-                        if staff_restdays[sid].get(week_of_month) == date:
-                            continue
                     
                     # 週班別一致性評分
                     week_consistency_score = 0
                     if week_shift_consistency:
                         current_week_shifts = st['weekly_shifts'][week_of_month]
+                        # 每週班別最多兩種
+                        if len(current_week_shifts) >= 2 and sid_shift not in current_week_shifts:
+                            continue
                         if current_week_shifts:
                             if sid_shift in current_week_shifts:
                                 week_consistency_score = 0
                             else:
                                 week_consistency_score = 1
                     
-                    candidates.append((s, st['count'], st['shift_counts'].get(sid_shift, 0), week_consistency_score))
+                    candidates.append((s, st['count'], shift_counts.get(sid_shift, 0), week_consistency_score))
                 
-                # 排序候選人
-                candidates.sort(key=lambda c: (
-                    0 if c[3] == -1 else 1,  # 預先分配最優先
-                    c[3] if c[3] != -1 else 0,  # 週班別一致性
-                    c[1],  # 總班數
-                    c[2]   # 該班別次數
-                ))
+                # 排序候選人（候選人超過需求時才需要挑選前 required 名）
+                if 0 < required < len(candidates):
+                    candidates = heapq.nsmallest(required, candidates, key=lambda c: (
+                        0 if c[3] == -1 else 1,  # 預先分配最優先
+                        c[3] if c[3] != -1 else 0,  # 週班別一致性
+                        c[1],  # 總班數
+                        c[2]   # 該班別次數
+                    ))
                 
                 assigned = candidates[:required]
             
@@ -1562,20 +1701,21 @@ def execute_auto_schedule_logic(dates, months, total_weeks, max_per_day, max_con
                 st = staff_status[sid]
                 
                 st['count'] += 1
-                st['shift_counts'][sid_shift] = st['shift_counts'].get(sid_shift, 0) + 1
-                st['shift_counts'][date] = st['shift_counts'].get(date, 0) + 1
+                st['shift_counts'][sid_shift] += 1
+                st['shift_counts'][date] += 1
                 st['weekly_shifts'][week_of_month].add(sid_shift)
                 st['weekly_hours'][week_of_month] += 8
                 st['worked_days'][week_of_month] += 1
                 
-                conn.execute(
-                    '''INSERT INTO schedule
-                       (date, shift_id, staff_id, work_hours, is_auto, operator_id, created_at, updated_at)
-                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                    (date, sid_shift, sid, 8, 1, operator, now_str, now_str)
-                )
+                schedule_rows.append((date, sid_shift, sid, 8, 1, operator, now_str, now_str))
                 worked_today.add(sid)
     
+    conn.executemany(
+        '''INSERT INTO schedule
+           (date, shift_id, staff_id, work_hours, is_auto, operator_id, created_at, updated_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+        schedule_rows
+    )
     conn.commit()
     
     # 驗證結果
@@ -1622,33 +1762,42 @@ def export_schedule():
         params.append(f"%{filters['staff_name']}%")
     query += ' ORDER BY schedule.date, shift.name'
     conn = get_db_connection()
-    schedule = conn.execute(query, params).fetchall()
-    conn.close()
-    si = StringIO()
-    writer = csv.writer(si)
-    writer.writerow(['日期', '班別', '病房', '人員', '工時'])
-    for row in schedule:
-        writer.writerow([row['date'], row['shift_name'], row['ward'], row['staff_name'], row['work_hours']])
-    output = si.getvalue().encode('utf-8-sig')
-    return send_file(
-        BytesIO(output),
+    cursor = conn.execute(query, params)
+    
+    def generate():
+        """逐列讀取查詢結果並輸出 CSV，不需一次載入全部資料"""
+        si = StringIO()
+        writer = csv.writer(si)
+        writer.writerow(['日期', '班別', '病房', '人員', '工時'])
+        yield '\ufeff' + si.getvalue()  # UTF-8 BOM，讓 Excel 正確辨識編碼
+        # 每次取一批資料以 writerows 寫出（查詢欄位順序即 CSV 欄位順序）
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            si.seek(0)
+            si.truncate(0)
+            writer.writerows(rows)
+            yield si.getvalue()
+    
+    return Response(
+        stream_with_context(generate()),
         mimetype='text/csv',
-        as_attachment=True,
-        download_name='schedule_export.csv'
+        headers={'Content-Disposition': 'attachment; filename=schedule_export.csv'}
     )
 
 @app.route('/pivot_schedule')
 @login_required
 def pivot_schedule():
     conn = get_db_connection()
-    schedule = conn.execute('''
+    # 直接迭代 cursor 轉成 dict，不先 fetchall 留一份 Row 清單
+    # （模板用 tojson 序列化，仍需完整 list，無法傳 generator）
+    data = [dict(row) for row in conn.execute('''
         SELECT schedule.date, shift.name as shift_name, shift.ward as ward, staff.name as staff_name, schedule.work_hours
         FROM schedule
         JOIN shift ON schedule.shift_id = shift.shift_id
         JOIN staff ON schedule.staff_id = staff.staff_id
-    ''').fetchall()
-    conn.close()
-    data = [dict(row) for row in schedule]
+    ''')]
     return render_template('pivot_schedule.html', data=data)
 
 @app.route('/calendar_view')
@@ -1700,7 +1849,6 @@ def calendar_view():
     query += ' ORDER BY schedule.date, shift.name'
     conn = get_db_connection()
     schedule = conn.execute(query, params).fetchall()
-    conn.close()
     
     # 轉換為 FullCalendar events 格式
     events = []
@@ -1735,13 +1883,9 @@ def staff_schedule_table():
     # 決定查詢的日期範圍
     if start_date and end_date:
         # 使用自訂日期範圍
-        start_obj = datetime.strptime(start_date, '%Y-%m-%d')
-        end_obj = datetime.strptime(end_date, '%Y-%m-%d')
-        dates = []
-        current_date = start_obj
-        while current_date <= end_obj:
-            dates.append(current_date.strftime('%Y-%m-%d'))
-            current_date += timedelta(days=1)
+        start_obj = parse_date(start_date)
+        end_obj = parse_date(end_date)
+        dates = [(start_obj + timedelta(days=i)).isoformat() for i in range((end_obj - start_obj).days + 1)]
         display_month = start_date[:7]  # 用起始日期的年月作為顯示
     else:
         # 使用月份查詢
@@ -1751,8 +1895,7 @@ def staff_schedule_table():
         display_month = month
     
     # 計算每天的星期
-    weekday_map = ['一', '二', '三', '四', '五', '六', '日']
-    weekdays = [weekday_map[datetime.strptime(d, "%Y-%m-%d").weekday()] for d in dates]
+    weekdays = [WEEKDAY_CN[wd] for wd in consecutive_weekdays(dates)]
     
     conn = get_db_connection()
     staff_list = conn.execute('SELECT staff_id, name, title FROM staff').fetchall()
@@ -1764,37 +1907,24 @@ def staff_schedule_table():
     ''', (dates[0], dates[-1])).fetchall()
     
     # 查詢請假記錄
-    leave_records = conn.execute('''
-        SELECT staff_id, start_date, end_date, leave_type
-        FROM leave_schedule
-        WHERE approved = 1 AND 
-              ((start_date <= ? AND end_date >= ?) OR 
-               (start_date >= ? AND start_date <= ?) OR
-               (end_date >= ? AND end_date <= ?))
-    ''', (dates[-1], dates[0], dates[0], dates[-1], dates[0], dates[-1])).fetchall()
+    leave_records = conn.execute(APPROVED_LEAVE_OVERLAP_SQL, (dates[-1], dates[0])).fetchall()
     
-    conn.close()
-    
-    schedule_map = {}
-    for row in schedule:
-        schedule_map.setdefault(row['staff_id'], {})[row['date']] = row['shift_name']
+    schedule_map = {(row['staff_id'], row['date']): row['shift_name'] for row in schedule}
     
-    # 建立請假對照表
+    # 建立請假對照表 key: (staff_id, date)
+    # dates 為連續日期，重疊區間直接換算成索引切片，不需逐日做日期運算
+    # 偏移量以解析後的日期計算，資料庫中未補零的日期字串也能正確對應
+    first_day = parse_date(dates[0])
+    last_index = len(dates) - 1
     leave_map = {}
     for leave in leave_records:
         staff_id = leave['staff_id']
-        start_date_obj = datetime.strptime(leave['start_date'], '%Y-%m-%d')
-        end_date_obj = datetime.strptime(leave['end_date'], '%Y-%m-%d')
-        
-        # 為請假期間的每一天建立記錄
-        current_date = start_date_obj
-        while current_date <= end_date_obj:
-            date_str = current_date.strftime('%Y-%m-%d')
-            if date_str in dates:  # 只處理在查詢範圍內的日期
-                if staff_id not in leave_map:
-                    leave_map[staff_id] = {}
-                leave_map[staff_id][date_str] = leave['leave_type']
-            current_date += timedelta(days=1)
+        leave_type = leave['leave_type']
+        # 只展開與查詢範圍重疊的日期
+        first = max((parse_date(leave['start_date']) - first_day).days, 0)
+        last = min((parse_date(leave['end_date']) - first_day).days, last_index)
+        for d in dates[first:last + 1]:
+            leave_map[(staff_id, d)] = leave_type
     
     table = []
     for staff in staff_list:
@@ -1805,13 +1935,12 @@ def staff_schedule_table():
             'leave_hours': 0,
             'shifts': []
         }
-        for d in dates:
-            shift = schedule_map.get(staff['staff_id'], {}).get(d, '')
+        for i, d in enumerate(dates):
+            shift = schedule_map.get((staff['staff_id'], d), '')
             # 檢查是否有請假記錄
-            leave_type = leave_map.get(staff['staff_id'], {}).get(d, '')
+            leave_type = leave_map.get((staff['staff_id'], d), '')
             # 檢查是否為星期天
-            date_obj = datetime.strptime(d, '%Y-%m-%d')
-            is_sunday = date_obj.weekday() == 6
+            is_sunday = weekdays[i] == '日'
             
             if shift:
                 row['shifts'].append(shift)
@@ -1846,8 +1975,13 @@ def login():
         password = request.form['password']
         conn = get_db_connection()
         user = conn.execute('SELECT * FROM user WHERE username = ?', (username,)).fetchone()
-        conn.close()
-        if user and check_password_hash(user['password_hash'], password):
+        verified = user is not None and check_password_hash(user['password_hash'], password)
+        if verified and not user['password_hash'].startswith(PASSWORD_HASH_METHOD + '$'):
+            # 舊參數（如 pbkdf2）的雜湊改以目前參數重新產生
+            conn.execute('UPDATE user SET password_hash=? WHERE user_id=?',
+                         (hash_password(password), user['user_id']))
+            conn.commit()
+        if verified:
             session['user_id'] = user['user_id']
             session['username'] = user['username']
             session['role'] = user['role']
@@ -1870,7 +2004,6 @@ def user_manage():
     conn = get_db_connection()
     users = conn.execute('SELECT * FROM user').fetchall()
     staff_list = conn.execute('SELECT staff_id, name FROM staff').fetchall()
-    conn.close()
     return render_template('user_manage.html', users=users, staff_list=staff_list)
 
 @app.route('/add_user', methods=['POST'])
@@ -1881,7 +2014,7 @@ def add_user():
     password = request.form['password']
     role = request.form['role']
     staff_id = request.form.get('staff_id') or None
-    pw_hash = generate_password_hash(password)
+    pw_hash = hash_password(password)
     conn = get_db_connection()
     try:
         conn.execute('INSERT INTO user (username, password_hash, role, staff_id) VALUES (?, ?, ?, ?)',
@@ -1890,7 +2023,6 @@ def add_user():
         flash('新增使用者成功', 'success')
     except sqlite3.IntegrityError:
         flash('帳號重複，請更換', 'danger')
-    conn.close()
     return redirect(url_for('user_manage'))
 
 @app.route('/edit_user', methods=['POST'])
@@ -1903,14 +2035,13 @@ def edit_user():
     staff_id = request.form.get('staff_id') or None
     conn = get_db_connection()
     if password:
-        pw_hash = generate_password_hash(password)
+        pw_hash = hash_password(password)
         conn.execute('UPDATE user SET password_hash=?, role=?, staff_id=? WHERE user_id=?',
                      (pw_hash, role, staff_id, user_id))
     else:
         conn.execute('UPDATE user SET role=?, staff_id=? WHERE user_id=?',
                      (role, staff_id, user_id))
     conn.commit()
-    conn.close()
     flash('修改使用者成功', 'success')
     return redirect(url_for('user_manage'))
 
@@ -1922,7 +2053,6 @@ def delete_user():
     conn = get_db_connection()
     conn.execute('DELETE FROM user WHERE user_id=?', (user_id,))
     conn.commit()
-    conn.close()
     flash('刪除使用者成功', 'info')
     return redirect(url_for('user_manage'))
 
@@ -1932,9 +2062,11 @@ def delete_user():
 def download_user_template():
     si = StringIO()
     writer = csv.writer(si)
-    writer.writerow(['username', 'password', 'role', 'staff_id'])
-    writer.writerow(['nurse01', '123456', 'staff', 'N001'])
-    writer.writerow(['admin02', 'adminpw', 'admin', ''])
+    writer.writerows([
+        ['username', 'password', 'role', 'staff_id'],
+        ['nurse01', '123456', 'staff', 'N001'],
+        ['admin02', 'adminpw', 'admin', ''],
+    ])
     output = si.getvalue().encode('utf-8-sig')
     return send_file(
         BytesIO(output),
@@ -1953,19 +2085,18 @@ def upload_user():
         return redirect(url_for('user_manage'))
     stream = StringIO(file.stream.read().decode('utf-8-sig'))
     reader = csv.DictReader(stream)
+    rows = [row for row in reader if row.get('username') and row.get('password') and row.get('role')]
+    # 密碼雜湊為 CPU 密集運算，hashlib 計算時會釋放 GIL，以多執行緒平行處理
+    with ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS) as executor:
+        pw_hashes = list(executor.map(hash_password, [row['password'] for row in rows]))
     conn = get_db_connection()
-    count = 0
-    for row in reader:
-        if row.get('username') and row.get('password') and row.get('role'):
-            pw_hash = generate_password_hash(row['password'])
-            try:
-                conn.execute('INSERT INTO user (username, password_hash, role, staff_id) VALUES (?, ?, ?, ?)',
-                             (row['username'], pw_hash, row['role'], row.get('staff_id') or None))
-                count += 1
-            except sqlite3.IntegrityError:
-                continue  # 跳過重複帳號
+    cursor = conn.executemany(
+        'INSERT OR IGNORE INTO user (username, password_hash, role, staff_id) VALUES (?, ?, ?, ?)',  # 跳過重複帳號
+        [(row['username'], pw_hash, row['role'], row.get('staff_id') or None)
+         for row, pw_hash in zip(rows, pw_hashes)]
+    )
+    count = cursor.rowcount
     conn.commit()
-    conn.close()
     flash(f'成功匯入 {count} 筆使用者', 'success')
     return redirect(url_for('user_manage'))
 
@@ -1988,7 +2119,6 @@ def edit_schedule():
     before = conn.execute('SELECT * FROM schedule WHERE id = ?', (schedule_id,)).fetchone()
     if not before:
         flash('找不到班表資料', 'danger')
-        conn.close()
         return redirect(url_for('view_schedule'))
     before_data = dict(before)
     conn.execute('UPDATE schedule SET staff_id=?, work_hours=?, status=?, remark=?, updated_at=?, operator_id=? WHERE id=?',
@@ -1998,7 +2128,6 @@ def edit_schedule():
     conn.execute('INSERT INTO schedule_log (schedule_id, action, before_data, after_data, operator_id, operated_at) VALUES (?, ?, ?, ?, ?, ?)',
                  (schedule_id, 'edit', json.dumps(before_data, ensure_ascii=False), json.dumps(after_data, ensure_ascii=False), session.get('username', 'system'), datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
     conn.commit()
-    conn.close()
     flash('班表已更新', 'success')
     return redirect(url_for('view_schedule'))
 
@@ -2017,14 +2146,12 @@ def delete_schedule():
     before = conn.execute('SELECT * FROM schedule WHERE id = ?', (schedule_id,)).fetchone()
     if not before:
         flash('找不到班表資料', 'danger')
-        conn.close()
         return redirect(url_for('view_schedule'))
     before_data = dict(before)
     conn.execute('DELETE FROM schedule WHERE id = ?', (schedule_id,))
     conn.execute('INSERT INTO schedule_log (schedule_id, action, before_data, after_data, operator_id, operated_at) VALUES (?, ?, ?, ?, ?, ?)',
                  (schedule_id, 'delete', json.dumps(before_data, ensure_ascii=False), None, session.get('username', 'system'), datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
     conn.commit()
-    conn.close()
     flash('班表已刪除', 'success')
     return redirect(url_for('view_schedule'))
 
@@ -2034,7 +2161,6 @@ def delete_schedule():
 def schedule_log():
     conn = get_db_connection()
     logs = conn.execute('SELECT * FROM schedule_log ORDER BY created_at DESC LIMIT 100').fetchall()
-    conn.close()
     return render_template('schedule_log.html', logs=logs)
 
 # 新增：排班偏好設定頁面
@@ -2056,7 +2182,6 @@ def staff_preference():
     
     staff_list = conn.execute('SELECT * FROM staff ORDER BY staff_id').fetchall()
     shift_list = conn.execute('SELECT * FROM shift ORDER BY name').fetchall()
-    conn.close()
     
     today = datetime.today()
     default_month = today.strftime('%Y-%m')
@@ -2102,8 +2227,6 @@ def add_staff_preference():
         flash('排班偏好設定已儲存', 'success')
     except Exception as e:
         flash(f'儲存失敗：{str(e)}', 'danger')
-    finally:
-        conn.close()
     
     return redirect(url_for('staff_preference'))
 
@@ -2116,7 +2239,6 @@ def delete_staff_preference():
     conn = get_db_connection()
     conn.execute('DELETE FROM staff_preference WHERE id = ?', (pref_id,))
     conn.commit()
-    conn.close()
     flash('排班偏好設定已刪除', 'success')
     return redirect(url_for('staff_preference'))
 
@@ -2145,8 +2267,6 @@ def update_staff_preference():
         flash('排班偏好設定已更新', 'success')
     except Exception as e:
         flash(f'更新失敗：{str(e)}', 'danger')
-    finally:
-        conn.close()
     
     return redirect(url_for('staff_preference'))
 
@@ -2173,8 +2293,8 @@ def oncall_manage():
     if start_date and end_date:
         # 使用日期範圍查詢
         try:
-            start_obj = datetime.strptime(start_date, '%Y-%m-%d')
-            end_obj = datetime.strptime(end_date, '%Y-%m-%d')
+            start_obj = parse_date(start_date)
+            end_obj = parse_date(end_date)
             
             if start_obj > end_obj:
                 flash('起始日期不能大於結束日期', 'danger')
@@ -2183,44 +2303,31 @@ def oncall_manage():
                 flash('查詢時間範圍不能超過一年', 'danger')
                 start_date = end_date = ''
             else:
-                # 產生日期範圍內的所有日期
-                current_date = start_obj
+                # 一次讀取範圍內的 On Call 資料，依日期分組
+                query = ONCALL_RANGE_SQL
+                params = [start_date, end_date]
+                if staff_filter:
+                    # 有人員篩選
+                    query += ' AND ocs.staff_id = ?'
+                    params.append(staff_filter)
+                oncall_by_date = defaultdict(list)
+                for row in conn.execute(query, params):
+                    oncall_by_date[row['date']].append(row)
+                
+                # 只處理星期天：從範圍內第一個星期天起每次跳 7 天
+                current_date = start_obj + timedelta(days=(6 - start_obj.weekday()) % 7)
                 while current_date <= end_obj:
                     date_str = current_date.strftime('%Y-%m-%d')
-                    weekday = current_date.strftime('%A')
-                    weekday_cn = {'Monday': '一', 'Tuesday': '二', 'Wednesday': '三', 
-                                 'Thursday': '四', 'Friday': '五', 'Saturday': '六', 'Sunday': '日'}[weekday]
+                    sunday_count += 1
                     
-                    # 只處理星期天
-                    if current_date.weekday() == 6:  # 星期天
-                        sunday_count += 1
-                        
-                        # 查詢該日期的 On Call 人員
-                        if staff_filter:
-                            # 有人員篩選
-                            oncall_staff = conn.execute('''
-                                SELECT ocs.*, s.name as staff_name
-                                FROM oncall_schedule ocs
-                                JOIN staff s ON ocs.staff_id = s.staff_id
-                                WHERE ocs.date = ? AND ocs.staff_id = ?
-                            ''', (date_str, staff_filter)).fetchall()
-                        else:
-                            # 無人員篩選
-                            oncall_staff = conn.execute('''
-                                SELECT ocs.*, s.name as staff_name
-                                FROM oncall_schedule ocs
-                                JOIN staff s ON ocs.staff_id = s.staff_id
-                                WHERE ocs.date = ?
-                            ''', (date_str,)).fetchall()
-                        
-                        calendar_days.append({
-                            'date': date_str,
-                            'weekday': weekday_cn,
-                            'is_weekend': True,
-                            'oncall_staff': oncall_staff
-                        })
+                    calendar_days.append({
+                        'date': date_str,
+                        'weekday': '日',
+                        'is_weekend': True,
+                        'oncall_staff': oncall_by_date.get(date_str, [])
+                    })
                     
-                    current_date += timedelta(days=1)
+                    current_date += timedelta(days=7)
                     
         except ValueError:
             flash('日期格式錯誤', 'danger')
@@ -2230,43 +2337,33 @@ def oncall_manage():
         if staff_filter:
             # 有人員篩選時，使用自定義查詢
             year, month = map(int, current_month.split('-'))
-            _, last_day = monthrange(year, month)
+            first_weekday, last_day = monthrange(year, month)
             
-            for day in range(1, last_day + 1):
+            # 一次讀取該人員整月的 On Call 資料，依日期分組
+            oncall_by_date = defaultdict(list)
+            for row in conn.execute(ONCALL_RANGE_SQL + ' AND ocs.staff_id = ?',
+                                    (f"{year:04d}-{month:02d}-01", f"{year:04d}-{month:02d}-{last_day:02d}", staff_filter)):
+                oncall_by_date[row['date']].append(row)
+            
+            # 只處理星期天：從當月第一個星期天起每次跳 7 天
+            for day in range(1 + (6 - first_weekday) % 7, last_day + 1, 7):
                 date_str = f"{year:04d}-{month:02d}-{day:02d}"
-                date_obj = datetime(year, month, day)
-                weekday = date_obj.strftime('%A')
-                weekday_cn = {'Monday': '一', 'Tuesday': '二', 'Wednesday': '三', 
-                             'Thursday': '四', 'Friday': '五', 'Saturday': '六', 'Sunday': '日'}[weekday]
+                sunday_count += 1
                 
-                # 只處理星期天
-                if date_obj.weekday() == 6:  # 星期天
-                    sunday_count += 1
-                    
-                    # 查詢該日期的特定人員 On Call 資料
-                    oncall_staff = conn.execute('''
-                        SELECT ocs.*, s.name as staff_name
-                        FROM oncall_schedule ocs
-                        JOIN staff s ON ocs.staff_id = s.staff_id
-                        WHERE ocs.date = ? AND ocs.staff_id = ?
-                    ''', (date_str, staff_filter)).fetchall()
-                    
-                    calendar_days.append({
-                        'date': date_str,
-                        'weekday': weekday_cn,
-                        'is_weekend': True,
-                        'oncall_staff': oncall_staff
-                    })
+                calendar_days.append({
+                    'date': date_str,
+                    'weekday': '日',
+                    'is_weekend': True,
+                    'oncall_staff': oncall_by_date.get(date_str, [])
+                })
         else:
             # 無人員篩選，使用原本的函數
-            calendar_days = generate_calendar_days(current_month)
+            calendar_days = generate_calendar_days(current_month, conn)
             # 計算該月星期天數量
             for day in calendar_days:
                 if day['weekday'] == '日':
                     sunday_count += 1
     
-    conn.close()
-    
     return render_template('oncall_manage.html', 
                          staff_list=staff_list,
                          default_month=default_month,
@@ -2288,7 +2385,7 @@ def add_oncall():
     
     # 驗證是否為星期天
     try:
-        date_obj = datetime.strptime(date, '%Y-%m-%d')
+        date_obj = parse_date(date)
         if date_obj.weekday() != 6:  # 星期天是 weekday 6
             flash('只能為星期天設定 On Call！', 'danger')
             return redirect(url_for('oncall_manage'))
@@ -2316,8 +2413,6 @@ def add_oncall():
         conn.commit()
     except Exception as e:
         flash(f'儲存失敗：{str(e)}', 'danger')
-    finally:
-        conn.close()
     
     return redirect(url_for('oncall_manage'))
 
@@ -2343,8 +2438,6 @@ def delete_oncall():
             
     except Exception as e:
         flash(f'刪除失敗：{str(e)}', 'danger')
-    finally:
-        conn.close()
     
     return redirect(url_for('oncall_manage'))
 
@@ -2368,72 +2461,70 @@ def batch_oncall():
             flash('沒有可分配的人員', 'warning')
             return redirect(url_for('oncall_manage'))
         
+        # 一次查出已有 On Call 設定的星期天
+        existing = set()
+        if sunday_dates:
+            placeholder = ','.join('?' for _ in sunday_dates)
+            existing = {row['date'] for row in conn.execute(
+                f'SELECT date FROM oncall_schedule WHERE date IN ({placeholder})', sunday_dates)}
+        
         # 為每個星期天分配 On Call 人員（輪流分配）
+        oncall_rows = []
         for i, date in enumerate(sunday_dates):
             staff_index = i % len(staff_list)
             staff_id = staff_list[staff_index]['staff_id']
             
-            # 檢查是否已存在該日期的 On Call 設定
-            existing = conn.execute('SELECT id FROM oncall_schedule WHERE date = ?', (date,)).fetchone()
-            
-            if not existing:
-                conn.execute('INSERT INTO oncall_schedule (date, staff_id, status) VALUES (?, ?, ?)',
-                           (date, staff_id, 'oncall'))
+            if date not in existing:
+                oncall_rows.append((date, staff_id, 'oncall'))
             print(f"批次設定 {date} 星期天 On Call: {staff_id}")
         
+        conn.executemany('INSERT INTO oncall_schedule (date, staff_id, status) VALUES (?, ?, ?)', oncall_rows)
         conn.commit()
         flash(f'批次星期天 On Call 設定已完成，共設定 {len(sunday_dates)} 個星期天', 'success')
     except Exception as e:
         flash(f'批次設定失敗：{str(e)}', 'danger')
-    finally:
-        conn.close()
     
     return redirect(url_for('oncall_manage'))
 
-# 輔助函數：產生月曆資料
-def generate_calendar_days(month_str):
+# 輔助函數：月曆骨架（只依年月決定，與資料庫無關，可快取）
+@lru_cache(maxsize=128)
+def month_calendar_skeleton(month_str):
+    """回傳指定月份每天的 (日期, 星期, 是否星期天)"""
     year, month = map(int, month_str.split('-'))
-    _, last_day = monthrange(year, month)
-    
-    calendar_days = []
+    first_weekday, last_day = monthrange(year, month)  # 當月第一天的星期、天數
+    days = []
     for day in range(1, last_day + 1):
-        date = f"{year:04d}-{month:02d}-{day:02d}"
-        weekday = datetime(year, month, day).strftime('%A')
-        weekday_cn = {'Monday': '一', 'Tuesday': '二', 'Wednesday': '三', 
-                     'Thursday': '四', 'Friday': '五', 'Saturday': '六', 'Sunday': '日'}[weekday]
-        
-        # 取得該日期的 On Call 人員
+        weekday = (first_weekday + day - 1) % 7
+        days.append((f"{year:04d}-{month:02d}-{day:02d}", WEEKDAY_CN[weekday], weekday == 6))
+    return tuple(days)
+
+# 輔助函數：產生月曆資料
+def generate_calendar_days(month_str, conn=None):
+    skeleton = month_calendar_skeleton(month_str)
+    
+    # 一次取得整月的 On Call 人員，依日期分組
+    if conn is None:
         conn = get_db_connection()
-        oncall_staff = conn.execute('''
-            SELECT ocs.*, s.name as staff_name
-            FROM oncall_schedule ocs
-            JOIN staff s ON ocs.staff_id = s.staff_id
-            WHERE ocs.date = ?
-        ''', (date,)).fetchall()
-        conn.close()
-        
+    oncall_by_date = defaultdict(list)
+    for row in conn.execute(ONCALL_RANGE_SQL, (skeleton[0][0], skeleton[-1][0])):
+        oncall_by_date[row['date']].append(row)
+    
+    calendar_days = []
+    for date, weekday_cn, is_sunday in skeleton:
         calendar_days.append({
             'date': date,
             'weekday': weekday_cn,
-            'is_weekend': weekday == 'Sunday',  # 只有星期天標記為特殊日期
-            'oncall_staff': oncall_staff
+            'is_weekend': is_sunday,  # 只有星期天標記為特殊日期
+            'oncall_staff': oncall_by_date.get(date, [])
         })
     
     return calendar_days
 
 # 輔助函數：取得星期天日期
+@lru_cache(maxsize=128)
 def get_weekend_dates(month_str):
-    """取得指定月份的所有星期天日期"""
-    year, month = map(int, month_str.split('-'))
-    _, last_day = monthrange(year, month)
-    
-    sunday_dates = []
-    for day in range(1, last_day + 1):
-        date = datetime(year, month, day)
-        if date.weekday() == 6:  # 星期天是 weekday 6
-            sunday_dates.append(date.strftime('%Y-%m-%d'))
-    
-    return sunday_dates
+    """取得指定月份的所有星期天日期（回傳 tuple，供快取共用）"""
+    return tuple(date for date, _, is_sunday in month_calendar_skeleton(month_str) if is_sunday)
 
 @app.route('/weekly_stats')
 @login_required
@@ -2457,8 +2548,6 @@ def weekly_stats():
     # 取得四周變形工時設定
     config = conn.execute('SELECT * FROM work_schedule_config WHERE month = ?', (month,)).fetchone()
     
-    conn.close()
-    
     return render_template('weekly_stats.html', stats=stats, config=config, month=month)
 
 @app.route('/night_shift_allocation')
@@ -2492,13 +2581,9 @@ def night_shift_allocation():
         FROM night_shift_allocation nsa
         JOIN staff s ON nsa.staff_id = s.staff_id
         JOIN shift sh ON nsa.shift_id = sh.shift_id
-        WHERE (nsa.start_date <= ? AND nsa.end_date >= ?) OR 
-              (nsa.start_date >= ? AND nsa.start_date <= ?) OR
-              (nsa.end_date >= ? AND nsa.end_date <= ?)
+        WHERE nsa.start_date <= ? AND nsa.end_date >= ?
         ORDER BY nsa.start_date, nsa.staff_id
-    ''', (end_date, start_date, start_date, end_date, start_date, end_date)).fetchall()
-    
-    conn.close()
+    ''', (end_date, start_date)).fetchall()
     
     return render_template('night_shift_allocation.html', 
                          staff_list=staff_list, 
@@ -2533,8 +2618,6 @@ def add_night_shift_allocation():
         flash('該員工在此時間範圍已有大夜班分配', 'error')
     except Exception as e:
         flash(f'新增失敗：{str(e)}', 'error')
-    finally:
-        conn.close()
     
     return redirect(url_for('night_shift_allocation', start_date=query_start, end_date=query_end))
 
@@ -2553,8 +2636,6 @@ def delete_night_shift_allocation():
         flash('大夜班預先分配刪除成功', 'success')
     except Exception as e:
         flash(f'刪除失敗：{str(e)}', 'error')
-    finally:
-        conn.close()
     
     return redirect(url_for('night_shift_allocation', start_date=query_start, end_date=query_end))
 
@@ -2573,19 +2654,18 @@ def batch_night_shift_allocation():
         
         # 清除該日期範圍的舊分配
         conn.execute('''DELETE FROM night_shift_allocation 
-                        WHERE (start_date <= ? AND end_date >= ?) OR 
-                              (start_date >= ? AND start_date <= ?) OR
-                              (end_date >= ? AND end_date <= ?)''', 
-                    (end_date, start_date, start_date, end_date, start_date, end_date))
+                        WHERE start_date <= ? AND end_date >= ?''', 
+                    (end_date, start_date))
         
         # 隨機分配大夜班
         staff_ids = [s['staff_id'] for s in staff_list]
         random.shuffle(staff_ids)
         
         # 按週分配（每週 7 天）
-        current_date = datetime.strptime(start_date, '%Y-%m-%d')
-        end_date_obj = datetime.strptime(end_date, '%Y-%m-%d')
+        current_date = parse_date(start_date)
+        end_date_obj = parse_date(end_date)
         
+        allocation_rows = []
         while current_date <= end_date_obj:
             # 找到這週的開始（週一）
             week_start = current_date - timedelta(days=current_date.weekday())
@@ -2598,11 +2678,7 @@ def batch_night_shift_allocation():
                 part1_end = min(week_start + timedelta(days=3), end_date_obj)    # 週四
                 
                 if part1_start <= part1_end and part1_start <= end_date_obj:
-                    conn.execute('''
-                        INSERT INTO night_shift_allocation 
-                        (start_date, end_date, staff_id, shift_id)
-                        VALUES (?, ?, ?, ?)
-                    ''', (part1_start.strftime('%Y-%m-%d'), part1_end.strftime('%Y-%m-%d'), staff1, shift_id))
+                    allocation_rows.append((part1_start.isoformat(), part1_end.isoformat(), staff1, shift_id))
                 
                 # 第二個人：週四-週六
                 staff2 = staff_ids.pop() if staff_ids else staff1
@@ -2610,21 +2686,20 @@ def batch_night_shift_allocation():
                 part2_end = min(week_start + timedelta(days=5), end_date_obj)    # 週六
                 
                 if part2_start <= part2_end and part2_start <= end_date_obj:
-                    conn.execute('''
-                        INSERT INTO night_shift_allocation 
-                        (start_date, end_date, staff_id, shift_id)
-                        VALUES (?, ?, ?, ?)
-                    ''', (part2_start.strftime('%Y-%m-%d'), part2_end.strftime('%Y-%m-%d'), staff2, shift_id))
+                    allocation_rows.append((part2_start.isoformat(), part2_end.isoformat(), staff2, shift_id))
             
             # 移到下週
             current_date = week_end + timedelta(days=1)
         
+        conn.executemany('''
+            INSERT INTO night_shift_allocation 
+            (start_date, end_date, staff_id, shift_id)
+            VALUES (?, ?, ?, ?)
+        ''', allocation_rows)
         conn.commit()
         flash('大夜班批次分配完成', 'success')
     except Exception as e:
         flash(f'批次分配失敗：{str(e)}', 'error')
-    finally:
-        conn.close()
     
     return redirect(url_for('night_shift_allocation', start_date=start_date, end_date=end_date))
 
@@ -2657,8 +2732,8 @@ def leave_manage():
     params = []
     
     if start_date and end_date:
-        query += ' AND ((ls.start_date <= ? AND ls.end_date >= ?) OR (ls.start_date >= ? AND ls.start_date <= ?))'
-        params.extend([end_date, start_date, start_date, end_date])
+        query += ' AND ls.start_date <= ? AND ls.end_date >= ?'
+        params.extend([end_date, start_date])
     
     if staff_filter:
         query += ' AND ls.staff_id = ?'
@@ -2678,19 +2753,14 @@ def leave_manage():
     for leave in leaves_raw:
         leave_dict = dict(leave)
         # 計算請假天數（排除星期天）
-        start_date_obj = datetime.strptime(leave['start_date'], '%Y-%m-%d')
-        end_date_obj = datetime.strptime(leave['end_date'], '%Y-%m-%d')
+        start_date_obj = parse_date(leave['start_date'])
+        end_date_obj = parse_date(leave['end_date'])
         
         # 計算總天數
         total_days = (end_date_obj - start_date_obj).days + 1
         
         # 計算期間內的星期天數量
-        sunday_count = 0
-        current_date = start_date_obj
-        while current_date <= end_date_obj:
-            if current_date.weekday() == 6:  # 星期天
-                sunday_count += 1
-            current_date += timedelta(days=1)
+        sunday_count = sundays_between(start_date_obj, end_date_obj)
         
         # 實際請假天數 = 總天數 - 星期天數量
         leave_days = total_days - sunday_count
@@ -2702,15 +2772,10 @@ def leave_manage():
     # 取得員工清單
     staff_list = conn.execute('SELECT staff_id, name FROM staff ORDER BY name').fetchall()
     
-    # 請假假別選項
-    leave_types = ['事假', '病假', '特休', '婚假', '喪假', '產假', '陪產假', '其他']
-    
-    conn.close()
-    
     return render_template('leave_manage.html', 
                          leaves=leaves,
                          staff_list=staff_list,
-                         leave_types=leave_types,
+                         leave_types=LEAVE_TYPES,
                          start_date=start_date,
                          end_date=end_date,
                          staff_filter=staff_filter,
@@ -2730,8 +2795,8 @@ def add_leave():
     
     # 驗證日期
     try:
-        start_obj = datetime.strptime(start_date, '%Y-%m-%d')
-        end_obj = datetime.strptime(end_date, '%Y-%m-%d')
+        start_obj = parse_date(start_date)
+        end_obj = parse_date(end_date)
         
         if start_obj > end_obj:
             flash('起始日期不能大於結束日期', 'danger')
@@ -2747,15 +2812,13 @@ def add_leave():
             INSERT INTO leave_schedule 
             (staff_id, leave_type, start_date, end_date, reason, approved, operator_id, updated_at)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (staff_id, leave_type, start_date, end_date, reason, approved, 
+        ''', (staff_id, leave_type, start_obj.isoformat(), end_obj.isoformat(), reason, approved, 
               session.get('username', 'system'), datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
         
         conn.commit()
         flash('請假記錄新增成功', 'success')
     except Exception as e:
         flash(f'新增失敗：{str(e)}', 'danger')
-    finally:
-        conn.close()
     
     return redirect(url_for('leave_manage'))
 
@@ -2774,8 +2837,8 @@ def edit_leave():
     
     # 驗證日期
     try:
-        start_obj = datetime.strptime(start_date, '%Y-%m-%d')
-        end_obj = datetime.strptime(end_date, '%Y-%m-%d')
+        start_obj = parse_date(start_date)
+        end_obj = parse_date(end_date)
         
         if start_obj > end_obj:
             flash('起始日期不能大於結束日期', 'danger')
@@ -2792,7 +2855,7 @@ def edit_leave():
             SET staff_id = ?, leave_type = ?, start_date = ?, end_date = ?, 
                 reason = ?, approved = ?, operator_id = ?, updated_at = ?
             WHERE id = ?
-        ''', (staff_id, leave_type, start_date, end_date, reason, approved,
+        ''', (staff_id, leave_type, start_obj.isoformat(), end_obj.isoformat(), reason, approved,
               session.get('username', 'system'), datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
               leave_id))
         
@@ -2800,8 +2863,6 @@ def edit_leave():
         flash('請假記錄更新成功', 'success')
     except Exception as e:
         flash(f'更新失敗：{str(e)}', 'danger')
-    finally:
-        conn.close()
     
     return redirect(url_for('leave_manage'))
 
@@ -2819,8 +2880,6 @@ def delete_leave():
         flash('請假記錄刪除成功', 'success')
     except Exception as e:
         flash(f'刪除失敗：{str(e)}', 'danger')
-    finally:
-        conn.close()
     
     return redirect(url_for('leave_manage'))
 
@@ -2858,7 +2917,12 @@ def upload_leave():
         reader = csv.DictReader(stream)
         
         conn = get_db_connection()
-        count = 0
+        # 一次取得所有員工編號，於記憶體中驗證
+        valid_staff = {row['staff_id'] for row in conn.execute('SELECT staff_id FROM staff')}
+        # 同一批上傳共用操作者與時間戳記
+        operator_id = session.get('username', 'system')
+        now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        leave_rows = []
         errors = []
         
         for row_num, row in enumerate(reader, start=2):  # 從第2行開始（第1行是標題）
@@ -2875,15 +2939,14 @@ def upload_leave():
                     continue
                 
                 # 驗證員工是否存在
-                staff_exists = conn.execute('SELECT COUNT(*) FROM staff WHERE staff_id = ?', (staff_id,)).fetchone()[0]
-                if not staff_exists:
+                if staff_id not in valid_staff:
                     errors.append(f'第{row_num}行：員工編號 {staff_id} 不存在')
                     continue
                 
                 # 驗證日期格式
                 try:
-                    start_obj = datetime.strptime(start_date, '%Y-%m-%d')
-                    end_obj = datetime.strptime(end_date, '%Y-%m-%d')
+                    start_obj = parse_date(start_date)
+                    end_obj = parse_date(end_date)
                     if start_obj > end_obj:
                         errors.append(f'第{row_num}行：起始日期不能大於結束日期')
                         continue
@@ -2892,26 +2955,24 @@ def upload_leave():
                     continue
                 
                 # 驗證請假假別
-                valid_types = ['事假', '病假', '特休', '婚假', '喪假', '產假', '陪產假', '其他']
-                if leave_type not in valid_types:
+                if leave_type not in VALID_LEAVE_TYPES:
                     errors.append(f'第{row_num}行：無效的請假假別 {leave_type}')
                     continue
                 
-                # 新增請假記錄
-                conn.execute('''
-                    INSERT INTO leave_schedule 
-                    (staff_id, leave_type, start_date, end_date, reason, approved, operator_id, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (staff_id, leave_type, start_date, end_date, reason, True,
-                      session.get('username', 'system'), datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-                
-                count += 1
+                # 收集請假記錄，稍後批次新增
+                # 一律以 YYYY-MM-DD 儲存
+                leave_rows.append((staff_id, leave_type, start_obj.isoformat(), end_obj.isoformat(), reason, True, operator_id, now_str))
             except Exception as e:
                 errors.append(f'第{row_num}行：{str(e)}')
                 continue
         
+        conn.executemany('''
+            INSERT INTO leave_schedule 
+            (staff_id, leave_type, start_date, end_date, reason, approved, operator_id, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', leave_rows)
         conn.commit()
-        conn.close()
+        count = len(leave_rows)
         
         if count > 0:
             flash(f'成功匯入 {count} 筆請假記錄', 'success')
@@ -2949,27 +3010,18 @@ def export_staff_schedule_table():
     if custom_shift_name and custom_shift_code:
         replacement_codes[custom_shift_name] = custom_shift_code
     
-    def apply_replacement(text):
-        """套用文字替代規則"""
-        if not text:  # 處理空白或 None
-            return replacement_codes.get('', '') or ''
-        
-        # 檢查是否有對應的替代代碼
-        if text in replacement_codes and replacement_codes[text]:
-            return replacement_codes[text]
-        
-        return text
+    # 只保留有填寫的替代代碼；查不到時沿用原文字
+    replacements = {text: code for text, code in replacement_codes.items() if code}
+    holiday_text = replacements.get('例假日', '例假日')
+    rest_day_text = replacements.get('休息日', '休息日')
+    leave_text = replacements.get('其他排休', '其他排休')
     
     # 決定查詢的日期範圍
     if start_date and end_date:
         # 使用自訂日期範圍
-        start_obj = datetime.strptime(start_date, '%Y-%m-%d')
-        end_obj = datetime.strptime(end_date, '%Y-%m-%d')
-        dates = []
-        current_date = start_obj
-        while current_date <= end_obj:
-            dates.append(current_date.strftime('%Y-%m-%d'))
-            current_date += timedelta(days=1)
+        start_obj = parse_date(start_date)
+        end_obj = parse_date(end_date)
+        dates = [(start_obj + timedelta(days=i)).isoformat() for i in range((end_obj - start_obj).days + 1)]
         filename_suffix = f"{start_date}_to_{end_date}"
     else:
         # 使用月份查詢
@@ -2979,8 +3031,7 @@ def export_staff_schedule_table():
         filename_suffix = month
     
     # 計算每天的星期
-    weekday_map = ['一', '二', '三', '四', '五', '六', '日']
-    weekdays = [weekday_map[datetime.strptime(d, "%Y-%m-%d").weekday()] for d in dates]
+    weekdays = [WEEKDAY_CN[wd] for wd in consecutive_weekdays(dates)]
     
     conn = get_db_connection()
     staff_list = conn.execute('SELECT staff_id, name, title FROM staff').fetchall()
@@ -2989,105 +3040,87 @@ def export_staff_schedule_table():
         FROM schedule
         JOIN shift ON schedule.shift_id = shift.shift_id
         WHERE schedule.date BETWEEN ? AND ?
-    ''', (dates[0], dates[-1])).fetchall()
-    
-    # 查詢請假記錄（與staff_schedule_table相同邏輯）
-    leave_records = conn.execute('''
-        SELECT staff_id, start_date, end_date, leave_type
-        FROM leave_schedule
-        WHERE approved = 1 AND 
-              ((start_date <= ? AND end_date >= ?) OR 
-               (start_date >= ? AND start_date <= ?) OR
-               (end_date >= ? AND end_date <= ?))
-    ''', (dates[-1], dates[0], dates[0], dates[-1], dates[0], dates[-1])).fetchall()
-    
-    conn.close()
+    ''', (dates[0], dates[-1]))
+    
+    # 查詢請假記錄：以遞迴 CTE 在 SQLite 內展開成每日一筆（只取查詢範圍內的日期）
+    leave_days = conn.execute('''
+        WITH RECURSIVE leave_days(staff_id, date, end_date, leave_type) AS (
+            SELECT staff_id, MAX(start_date, ?), MIN(end_date, ?), leave_type
+            FROM leave_schedule
+            WHERE approved = 1 AND start_date <= ? AND end_date >= ?
+            UNION ALL
+            SELECT staff_id, DATE(date, '+1 day'), end_date, leave_type
+            FROM leave_days
+            WHERE date < end_date
+        )
+        SELECT staff_id, date, leave_type FROM leave_days
+    ''', (dates[0], dates[-1], dates[-1], dates[0]))
     
+    # 直接迭代 cursor 建立對照表，不先 fetchall
     schedule_map = {}
     for row in schedule:
         schedule_map.setdefault(row['staff_id'], {})[row['date']] = row['shift_name']
     
     # 建立請假對照表
     leave_map = {}
-    for leave in leave_records:
-        staff_id = leave['staff_id']
-        start_date_obj = datetime.strptime(leave['start_date'], '%Y-%m-%d')
-        end_date_obj = datetime.strptime(leave['end_date'], '%Y-%m-%d')
-        
-        # 為請假期間的每一天建立記錄
-        current_date = start_date_obj
-        while current_date <= end_date_obj:
-            date_str = current_date.strftime('%Y-%m-%d')
-            if date_str in dates:  # 只處理在查詢範圍內的日期
-                if staff_id not in leave_map:
-                    leave_map[staff_id] = {}
-                leave_map[staff_id][date_str] = leave['leave_type']
-            current_date += timedelta(days=1)
-    
-    # 建立 CSV 內容
-    si = StringIO()
-    writer = csv.writer(si)
-    
-    # 寫入標題行
-    header = ['姓名', '職稱', '總工時', '累積未休時數']
-    for i, d in enumerate(dates):
-        header.append(f"{d[8:]}({weekdays[i]})")
-    writer.writerow(header)
+    for row in leave_days:
+        leave_map.setdefault(row['staff_id'], {})[row['date']] = row['leave_type']
     
-    # 寫入資料行
-    for staff in staff_list:
-        row = [staff['name'], staff['title']]
-        total_hours = 0
-        leave_hours = 0  # 暫時設為0，可根據需求調整
+    def generate():
+        """逐位員工產生 CSV 資料行，不需先組出整份檔案"""
+        si = StringIO()
+        writer = csv.writer(si)
         
-        # 計算總工時並收集排班資料
-        shifts_data = []
+        # 寫入標題行
+        header = ['姓名', '職稱', '總工時', '累積未休時數']
         for i, d in enumerate(dates):
-            shift = schedule_map.get(staff['staff_id'], {}).get(d, '')
-            leave_type = leave_map.get(staff['staff_id'], {}).get(d, '')
+            header.append(f"{d[8:]}({weekdays[i]})")
+        writer.writerow(header)
+        yield '\ufeff' + si.getvalue()  # UTF-8 BOM，讓 Excel 正確辨識編碼
+        
+        # 寫入資料行
+        for staff in staff_list:
+            row = [staff['name'], staff['title']]
+            total_hours = 0
+            leave_hours = 0  # 暫時設為0，可根據需求調整
             
-            if shift:
-                # 有排班
-                processed_shift = apply_replacement(shift)
-                shifts_data.append(processed_shift)
-                total_hours += 8
-            elif leave_type:
-                # 有請假記錄
-                if weekdays[i] == '日':
-                    # 請假的星期天顯示為例假日
-                    processed_text = apply_replacement('例假日')
-                    shifts_data.append(processed_text)
-                else:
+            # 計算總工時並收集排班資料
+            staff_schedule = schedule_map.get(staff['staff_id'], {})
+            staff_leave = leave_map.get(staff['staff_id'], {})
+            shifts_data = []
+            for i, d in enumerate(dates):
+                shift = staff_schedule.get(d, '')
+                
+                if shift:
+                    # 有排班
+                    shifts_data.append(replacements.get(shift, shift))
+                    total_hours += 8
+                elif weekdays[i] == '日':
+                    # 星期天（含請假）顯示為例假日
+                    shifts_data.append(holiday_text)
+                elif d in staff_leave:
                     # 平日請假顯示為其他排休
-                    processed_text = apply_replacement('其他排休')
-                    shifts_data.append(processed_text)
-            else:
-                # 根據星期判斷是例假日還是休息日
-                if weekdays[i] == '日':
-                    processed_text = apply_replacement('例假日')
-                    shifts_data.append(processed_text)
-                elif weekdays[i] == '六':
-                    processed_text = apply_replacement('休息日')
-                    shifts_data.append(processed_text)
+                    shifts_data.append(leave_text)
                 else:
-                    processed_text = apply_replacement('休息日')
-                    shifts_data.append(processed_text)
-        
-        row.extend([total_hours, leave_hours])
-        row.extend(shifts_data)
-        writer.writerow(row)
-    
-    output = si.getvalue().encode('utf-8-sig')
+                    shifts_data.append(rest_day_text)
+            
+            row.extend([total_hours, leave_hours])
+            row.extend(shifts_data)
+            si.seek(0)
+            si.truncate(0)
+            writer.writerow(row)
+            yield si.getvalue()
     
     # 根據是否有使用替代代碼來調整檔名
     has_replacement = any(code for code in replacement_codes.values() if code)
     suffix = "_已替代" if has_replacement else ""
+    download_name = f'員工橫式排班表_{filename_suffix}{suffix}.csv'
     
-    return send_file(
-        BytesIO(output),
+    return Response(
+        stream_with_context(generate()),
         mimetype='text/csv',
-        as_attachment=True,
-        download_name=f'員工橫式排班表_{filename_suffix}{suffix}.csv'
+        # 中文檔名需以 RFC 5987 編碼放入標頭
+        headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(download_name)}"}
     )
 
 import os